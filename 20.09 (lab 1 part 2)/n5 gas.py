@@ -1,16 +1,48 @@
-import turtle, math
+import math, argparse, multiprocessing, struct, threading, queue, os, time, json, platform, sys
+import hashlib, itertools, csv, functools, heapq, subprocess, types, asyncio
+from multiprocessing import shared_memory, resource_tracker
 from random import *
 
+import numpy as np
+
+try:
+    import turtle
+except ImportError:
+    # headless servers without Tk can still run with --headless
+    turtle = None
+
+try:
+    # no greeting on every headless run
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import pygame
+except ImportError:
+    # only needed for --renderer pygame
+    pygame = None
+
+R0 = 30
+RCUT = 100
+# set by --force linear/cubic, used by force() instead of the pow calls
+FORCE_TABLE = None
+
+def make_turtle(x, y):
+    drawParticle = turtle.Turtle()
+    drawParticle.shape('circle')
+    drawParticle.penup()
+    drawParticle.speed(0)
+    drawParticle.goto(x, y)
+    drawParticle.turtlesize(0.5,0.5,1)
+    return drawParticle
+
 class Particle:
 
-    def __init__(self, x, y, vx, vy):
+    # no per-instance __dict__, a headless Particle is just five slots
+    __slots__ = ('drawParticle', 'x', 'y', 'vx', 'vy')
 
-        self.drawParticle = turtle.Turtle()
-        self.drawParticle.shape('circle')
-        self.drawParticle.penup()
-        self.drawParticle.speed(50)
-        self.drawParticle.goto(x, y)
-        self.drawParticle.turtlesize(0.5,0.5,1)
+    def __init__(self, x, y, vx, vy, draw=True):
+
+        self.drawParticle = None
+        if draw:
+            self.drawParticle = make_turtle(x, y)
         
         self.x = x
         self.y = y
@@ -25,30 +57,31 @@ class Particle:
         self.x += self.vx * dt
         self.y += self.vy * dt
 
-        self.drawParticle.goto(self.x, self.y)
-
-
 
 def distance(P1,P2):
     k0 = 2 * k
-    if abs(P1.x - P2.x) < abs(P1.x - P2.x - k0):
-        dx = P1.x - P2.x
-    else:
-        dx = P1.x - P2.x - k0
+    dx = P1.x - P2.x
+    dy = P1.y - P2.y
 
-    if abs(P1.y - P2.y) < abs(P1.y - P2.y - k0):
-        dy = P1.y - P2.y
-    else:
-        dy = P1.y - P2.y - k0
+    # nearest periodic image, whichever side of the box it is on
+    dx -= k0 * round(dx / k0)
+    dy -= k0 * round(dy / k0)
     return dx, dy
 
 def force(P1, P2):
-    r0 = 30
+    r0 = R0
     dx, dy = distance(P1, P2)
 
+    if FORCE_TABLE:
+        dr2 = dx * dx + dy * dy
+        if dr2 >= RCUT ** 2:
+            return 0, 0
+        f = FORCE_TABLE.scalar(dr2)
+        return f * dx, f * dy
+
     dr = math.sqrt(dx ** 2 + dy ** 2)
 
-    if dr >= 100:
+    if dr >= RCUT:
         return 0, 0
     
     f = 12 * (r0 ** 12) / (dr ** 13) - 6 * (r0 ** 6) / (dr ** 7)
@@ -57,69 +90,2779 @@ def force(P1, P2):
     fy = f * dy / dr
     return fx, fy
 
-def main():
+def lj_force(dx, dy, dr2, table=None, params=None):
+    '''
+    Vectorized force() for arrays of minimum-image displacements that are
+    already known to be inside the cutoff (dr2 = dx ** 2 + dy ** 2).
+    Uses f / dr = (12 s ** 12 - 6 s ** 6) / dr ** 2 with s = r0 / dr,
+    so there is no sqrt and no large powers. With a ForceTable the
+    interpolated table is used instead. params is (epsilon, sigma ** 2)
+    per pair for a Mixture, the table only knows r0 so it is not used then.
+    '''
+    if params is not None:
+        f = lj_over_r(dr2, params[1], params[0])
+    elif table:
+        f = table(dr2)
+    else:
+        f = lj_over_r(dr2)
+
+    fx = f * dx
+    fy = f * dy
+    return fx, fy
+
+def lj_over_r(dr2, sigma2=R0 * R0, epsilon=None):
+    inv = 1 / dr2
+    s2 = sigma2 * inv
+    s6 = s2 * s2 * s2
+    if epsilon is None:
+        return (12 * s6 - 6) * s6 * inv
+    return epsilon * (12 * s6 - 6) * s6 * inv
+
+class Mixture:
+    '''
+    Several species in one gas: mass[a] of every species and the LJ
+    parameters epsilon[a][b], sigma[a][b] of every pair of species
+    (epsilon = 1, sigma = R0 is the one-species gas). Vectors instead of
+    matrices are combined with the Lorentz-Berthelot rules. The species
+    of the particles are an index array kind; the parameters of pairs
+    (i, j) are one gather from the flattened matrices at
+    kind[i] * species + kind[j], so there are no per-pair branches.
+    '''
+
+    def __init__(self, mass, epsilon=1, sigma=R0, fraction=None):
+        self.mass = np.array(mass, dtype=float).reshape(-1)
+        self.species = n = len(self.mass)
+        epsilon = np.array(epsilon, dtype=float)
+        sigma = np.array(sigma, dtype=float)
+        if epsilon.ndim == 1:
+            epsilon = np.sqrt(epsilon[:, None] * epsilon)
+        if sigma.ndim == 1:
+            sigma = (sigma[:, None] + sigma) / 2
+        epsilon = np.broadcast_to(epsilon, (n, n))
+        sigma = np.broadcast_to(sigma, (n, n))
+        if not (np.allclose(epsilon, epsilon.T) and np.allclose(sigma, sigma.T)):
+            raise ValueError('epsilon and sigma must be symmetric')
+        if sigma.max() > RCUT / 2:
+            raise ValueError('sigma must be well inside the cutoff RCUT = %s' % RCUT)
+        self.epsilon = epsilon.ravel()
+        self.sigma2 = (sigma * sigma).ravel()
+        if fraction is None:
+            fraction = np.ones(n)
+        self.fraction = np.array(fraction, dtype=float) / np.sum(fraction)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        JSON file with "mass" and optionally "epsilon", "sigma", "fraction".
+        '''
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(spec['mass'], spec.get('epsilon', 1), spec.get('sigma', R0),
+                   spec.get('fraction'))
+
+    def assign(self, N):
+        '''
+        Species of N particles in the proportions of fraction, shuffled.
+        '''
+        counts = np.floor(self.fraction * N).astype(int)
+        counts[:N - counts.sum()] += 1
+        kind = np.repeat(np.arange(self.species), counts)
+        return np.random.default_rng(getrandbits(64)).permutation(kind)
+
+    def params(self, kind, i, j):
+        p = kind[i] * self.species + kind[j]
+        return self.epsilon[p], self.sigma2[p]
+
+class ForceTable:
+    '''
+    f / dr of the LJ force on a uniform grid in dr ** 2, so a lookup needs
+    no sqrt and no powers. order is 1 (linear) or 3 (cubic Catmull-Rom);
+    more points and cubic are more accurate, fewer points and linear are
+    faster. Between 0.9 * RCUT and RCUT the force is multiplied by a
+    smoothstep, so it goes to zero smoothly at the cutoff instead of
+    jumping. Below r2min (closer than 0.6 r0) the analytic force is used,
+    the force is so steep there that the table would be too coarse.
+    '''
+
+    def __init__(self, size=4096, order=1, r2min=(0.6 * R0) ** 2):
+        self.order = order
+        self.lo = r2min
+        self.h = (RCUT ** 2 - r2min) / (size - 1)
+        self.inv_h = 1 / self.h
+
+        # one extra point before and two after, for the cubic stencil
+        grid = self.lo + self.h * np.arange(-1, size + 2)
+        self.values = lj_over_r(grid) * self.switch(grid)
+        self.list = self.values.tolist()
+
+    def switch(self, dr2):
+        on = (0.9 * RCUT) ** 2
+        t = np.clip((RCUT ** 2 - dr2) / (RCUT ** 2 - on), 0, 1)
+        return t * t * (3 - 2 * t)
+
+    def __call__(self, dr2):
+        u = (np.maximum(dr2, self.lo) - self.lo) * self.inv_h
+        i = u.astype(np.intp)
+        t = u - i
+        v = self.values
+        if self.order == 1:
+            a = v[i + 1]
+            f = a + t * (v[i + 2] - a)
+        else:
+            p0 = v[i]
+            p1 = v[i + 1]
+            p2 = v[i + 2]
+            p3 = v[i + 3]
+            f = p1 + 0.5 * t * (p2 - p0 + t * (2 * p0 - 5 * p1 + 4 * p2 - p3 + t * (3 * (p1 - p2) + p3 - p0)))
+
+        close = dr2 < self.lo
+        if close.any():
+            f[close] = lj_over_r(dr2[close])
+        return f
+
+    def scalar(self, dr2):
+        if dr2 < self.lo:
+            return lj_over_r(dr2)
+        u = (dr2 - self.lo) * self.inv_h
+        i = int(u)
+        t = u - i
+        v = self.list
+        if self.order == 1:
+            a = v[i + 1]
+            return a + t * (v[i + 2] - a)
+        p0, p1, p2, p3 = v[i:i + 4]
+        return p1 + 0.5 * t * (p2 - p0 + t * (2 * p0 - 5 * p1 + 4 * p2 - p3 + t * (3 * (p1 - p2) + p3 - p0)))
+
+def direct_accelerations(particles, pairs=None):
+    '''
+    Every pair is evaluated once and the equal and opposite force is
+    given to both particles. If pairs is a list, (dr2, r.F) of every
+    pair inside the cutoff is appended to it for the observables.
+    '''
+    acc = [[0, 0] for i in particles]
+    for i in range(len(particles)):
+        for j in range(i + 1, len(particles)):
+            fx, fy = force(particles[i], particles[j])
+            if pairs is not None and (fx or fy):
+                dx, dy = distance(particles[i], particles[j])
+                pairs.append((dx * dx + dy * dy, fx * dx + fy * dy))
+
+            acc[i][0] += fx
+            acc[i][1] += fy
+            acc[j][0] -= fx
+            acc[j][1] -= fy
+    return acc
+
+def build_cells(particles, m):
+    '''
+    Bins particle indices into an m x m grid covering the box.
+    '''
+    cells = {}
+    for i, p in enumerate(particles):
+        cx = int((p.x + k) / (2 * k) * m) % m
+        cy = int((p.y + k) / (2 * k) * m) % m
+        cells.setdefault((cx, cy), []).append(i)
+    return cells
+
+def cell_accelerations(particles, pairs=None):
+    '''
+    Same result as direct_accelerations, but a particle is only checked
+    against the 3 x 3 block of cells around it. Cells are at least RCUT
+    wide, so nothing inside the cutoff is missed. A pair is seen from
+    both of its cells, so only the i < j side computes the force.
+    '''
+    m = max(1, int(2 * k // RCUT))
+    cells = build_cells(particles, m)
+
+    acc = [[0, 0] for i in particles]
+    for (cx, cy), members in cells.items():
+        near = set()
+        for a in (-1, 0, 1):
+            for b in (-1, 0, 1):
+                near.add(((cx + a) % m, (cy + b) % m))
+        neighbours = []
+        for c in near:
+            neighbours += cells.get(c, [])
+
+        for i in members:
+            for j in neighbours:
+                if i < j:
+                    fx, fy = force(particles[i], particles[j])
+                    if pairs is not None and (fx or fy):
+                        dx, dy = distance(particles[i], particles[j])
+                        pairs.append((dx * dx + dy * dy, fx * dx + fy * dy))
+
+                    acc[i][0] += fx
+                    acc[i][1] += fy
+                    acc[j][0] -= fx
+                    acc[j][1] -= fy
+    return acc
+
+def pair_accelerations(x, y, k, table=None, pairs=None, block=64, mixture=None, kind=None):
+    '''
+    Pair forces, a block of rows at a time so memory stays at
+    block * N instead of N * N. Each block is only compared with the
+    particles after it, every pair inside the cutoff goes through
+    lj_force once and is added to both particles with opposite signs.
+    If pairs is a list, (i, j, dr2, r.F) arrays of the evaluated pairs
+    are appended to it for the observables. With a Mixture the pair
+    parameters come from the species in kind and the result is the
+    force, the caller divides by the masses.
+    '''
+    n = len(x)
+    k0 = 2 * k
+    ax = np.zeros(n)
+    ay = np.zeros(n)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+
+        dx = x[start:stop, None] - x[start:]
+        dx -= k0 * np.rint(dx / k0)
+        dy = y[start:stop, None] - y[start:]
+        dy -= k0 * np.rint(dy / k0)
+        dr2 = dx * dx + dy * dy
+
+        # keep j > i only, i and j are both counted from start
+        upper = np.arange(stop - start)[:, None] < np.arange(n - start)
+        i, j = np.nonzero((dr2 < RCUT ** 2) & upper)
+        params = None
+        if mixture:
+            params = mixture.params(kind, i + start, j + start)
+        fx, fy = lj_force(dx[i, j], dy[i, j], dr2[i, j], table, params)
+        if pairs is not None:
+            pairs.append((i + start, j + start, dr2[i, j], fx * dx[i, j] + fy * dy[i, j]))
+
+        ax[start:] += np.bincount(i, fx, n - start) - np.bincount(j, fx, n - start)
+        ay[start:] += np.bincount(i, fy, n - start) - np.bincount(j, fy, n - start)
+    return ax, ay
+
+def neighbor_pairs(x, y, k, rlist, chunk=1 << 20):
+    '''
+    All pairs i < j closer than rlist, as two index arrays sorted by
+    (i, j). Vectorized cell list: particles are sorted by cell, every
+    occupied cell is paired with itself and four of its neighbours (a
+    half shell), and each pair of cells is expanded into the counts[a] *
+    counts[b] candidate pairs of its particles, about chunk candidates
+    at a time to bound memory. Only occupied cells are stored and no cell
+    is padded, so the work is O(N) also for a few particles in a large
+    box, such as one slab of ParallelGas, and for one crowded cell among
+    sparse ones. Small boxes fall back to all pairs.
+    '''
+    n = len(x)
+    k0 = 2 * k
+    m = int(k0 // rlist)
+    if n == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    def close_pairs(i, j):
+        dx = x[i] - x[j]
+        dx -= k0 * np.rint(dx / k0)
+        dy = y[i] - y[j]
+        dy -= k0 * np.rint(dy / k0)
+        close = dx * dx + dy * dy < rlist ** 2
+        return np.minimum(i[close], j[close]), np.maximum(i[close], j[close])
+
+    if m < 3:
+        i, j = close_pairs(*np.triu_indices(n, 1))
+    else:
+        w = k0 / m
+        cx = ((x + k) / w).astype(np.intp) % m
+        cy = ((y + k) / w).astype(np.intp) % m
+        cell = cx * m + cy
+        order = np.argsort(cell, kind='stable')
+        occupied, starts, counts = np.unique(cell[order], return_index=True, return_counts=True)
+
+        # every (cell, neighbour cell) pair with both occupied, as rows of occupied
+        a = []
+        b = []
+        for offset in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            other = (occupied // m + offset[0]) % m * m + (occupied % m + offset[1]) % m
+            r = np.minimum(np.searchsorted(occupied, other), len(occupied) - 1)
+            found = occupied[r] == other
+            a.append(np.nonzero(found)[0])
+            b.append(r[found])
+        a = np.concatenate(a)
+        b = np.concatenate(b)
+        size = counts[a] * counts[b]
+        end = np.cumsum(size)
+
+        found_i = []
+        found_j = []
+        cuts = np.searchsorted(end, np.arange(chunk, end[-1], chunk), 'right')
+        cuts = np.unique(np.concatenate([[0], cuts, [len(a)]]))
+        for lo, hi in zip(cuts[:-1], cuts[1:]):
+            ca = a[lo:hi]
+            cb = b[lo:hi]
+            s = size[lo:hi]
+            pair = np.repeat(np.arange(hi - lo), s)
+            local = np.arange(s.sum()) - np.repeat(np.cumsum(s) - s, s)
+            width = counts[cb][pair]
+            ia = local // width
+            ib = local % width
+            # inside one cell every pair once
+            keep = (ca[pair] != cb[pair]) | (ia < ib)
+            i = order[starts[ca][pair][keep] + ia[keep]]
+            j = order[starts[cb][pair][keep] + ib[keep]]
+            i, j = close_pairs(i, j)
+            found_i.append(i)
+            found_j.append(j)
+        i = np.concatenate(found_i)
+        j = np.concatenate(found_j)
+
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+class NeighborList:
+    '''
+    Verlet neighbour list: all pairs within RCUT + skin, rebuilt only when
+    some particle has moved more than skin / 2 since the last build, so
+    no pair that has come inside RCUT can be missing. Between rebuilds a
+    force evaluation is a gather over the flat pair arrays.
+    '''
+
+    def __init__(self, skin=20):
+        self.skin = skin
+        self.i = None
+        self.j = None
+        self.x0 = None
+        self.y0 = None
+        self.builds = 0
+
+    def pairs(self, x, y, k):
+        if self.i is None or self.stale(x, y, k):
+            self.i, self.j = neighbor_pairs(x, y, k, RCUT + self.skin)
+            self.built(x, y)
+        return self.i, self.j
+
+    def stale(self, x, y, k):
+        '''
+        True if the list has to be rebuilt for these positions.
+        '''
+        return self.x0 is None or len(self.x0) != len(x) or self.moved(x, y, k) > self.skin / 2
+
+    def built(self, x, y):
+        self.x0 = x.copy()
+        self.y0 = y.copy()
+        self.builds += 1
+
+    def reset(self):
+        self.i = self.j = self.x0 = self.y0 = None
+
+    def moved(self, x, y, k):
+        k0 = 2 * k
+        dx = x - self.x0
+        dx -= k0 * np.rint(dx / k0)
+        dy = y - self.y0
+        dy -= k0 * np.rint(dy / k0)
+        return np.sqrt(np.max(dx * dx + dy * dy, initial=0))
+
+def spread_bits(v):
+    '''
+    Puts a zero bit between every two bits of the low 16 bits of v.
+    '''
+    v = v.astype(np.uint32) & 0xFFFF
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
+
+def morton_order(x, y, k, bits=10):
+    '''
+    Permutation that sorts the particles along a Z-order curve over a
+    2 ** bits x 2 ** bits grid of the box, so particles close in space get
+    close indices.
+    '''
+    side = 1 << bits
+    cx = np.clip(((x + k) * (side / (2 * k))).astype(np.intp), 0, side - 1)
+    cy = np.clip(((y + k) * (side / (2 * k))).astype(np.intp), 0, side - 1)
+    return np.argsort(spread_bits(cx) | spread_bits(cy) << 1, kind='stable')
+
+def by_id(gas, a):
+    '''
+    a (indexed by storage slot in the last axis) in the order of particle
+    ids, which is the order the particles were created in, see Gas.reorder.
+    '''
+    ids = getattr(gas, 'ids', None)
+    if ids is None:
+        return a
+    out = np.empty_like(a)
+    out[..., ids] = a
+    return out
+
+def list_accelerations(x, y, k, i, j, table=None, pairs=None, mixture=None, kind=None):
+    '''
+    pair_accelerations over the pairs of a NeighborList.
+    '''
+    n = len(x)
+    k0 = 2 * k
+    dx = x[i] - x[j]
+    dx -= k0 * np.rint(dx / k0)
+    dy = y[i] - y[j]
+    dy -= k0 * np.rint(dy / k0)
+    dr2 = dx * dx + dy * dy
+
+    inside = dr2 < RCUT ** 2
+    i = i[inside]
+    j = j[inside]
+    dx = dx[inside]
+    dy = dy[inside]
+    dr2 = dr2[inside]
+    params = None
+    if mixture:
+        params = mixture.params(kind, i, j)
+    fx, fy = lj_force(dx, dy, dr2, table, params)
+    if pairs is not None:
+        pairs.append((i, j, dr2, fx * dx + fy * dy))
+
+    ax = np.bincount(i, fx, n) - np.bincount(j, fx, n)
+    ay = np.bincount(i, fy, n) - np.bincount(j, fy, n)
+    return ax, ay
+
+class BarnesHut:
+    '''
+    Long-range 1 / r force (2D gravity or Coulomb) through a Barnes-Hut
+    quadtree, O(N log N) per evaluation. strength > 0 repels (like
+    charges), strength < 0 attracts (gravity). softening keeps close
+    encounters finite.
+
+    Everything is done with arrays. The tree is built level by level from
+    the particles sorted by Morton code, every node is a contiguous range
+    of the sorted particles. The walk is done for whole leaves at once: a
+    list of (leaf, node) pairs is refined level by level, a node is used
+    as its center of mass when its size is below theta times its distance
+    to the nearest point of the leaf, a leaf that is too close is summed
+    particle by particle. The forces are then gathers over these
+    interaction lists. theta = 0 gives the exact sum.
+
+    In the periodic box there is no Ewald sum: the force is tapered
+    smoothly to zero between half a box and a full box half-width k, so
+    every particle only feels the nearest image of every other one and
+    nodes beyond k are skipped. A hard minimum-image cut would force the
+    tree to open every node along the cut and lose the N log N scaling.
+    '''
+
+    def __init__(self, k, strength=-1000, theta=0.5, softening=5, leaf_size=16, depth=16):
+        self.k = k
+        self.strength = strength
+        self.theta = theta
+        self.eps2 = softening ** 2
+        self.leaf_size = leaf_size
+        self.depth = depth
+        # taper from on2 to off2 in r ** 2
+        self.off2 = k * k
+        self.on2 = self.off2 / 4
+
+        # potential of the tapered force inside the taper, integrated
+        # numerically once, in units of strength / 2
+        u = np.linspace(self.on2, self.off2, 2049)
+        f = self.taper(u) / (u + self.eps2)
+        tail = np.concatenate([[0], np.cumsum((f[1:] + f[:-1]) / 2 * np.diff(u))])
+        self.tail_u = u
+        self.tail = tail[-1] - tail
+
+    def taper(self, r2):
+        t = np.clip((self.off2 - r2) / (self.off2 - self.on2), 0, 1)
+        return t * t * (3 - 2 * t)
+
+    def potential(self, r2):
+        '''
+        U(r) of one unit mass pair, -dU/dr is the tapered force.
+        '''
+        inner = np.log((self.on2 + self.eps2) / (r2 + self.eps2)) + self.tail[0]
+        outer = np.interp(r2, self.tail_u, self.tail)
+        return self.strength / 2 * np.where(r2 <= self.on2, inner, outer)
+
+    def build(self, x, y, mass):
+        '''
+        Sorts the particles by Morton code and returns the tree as arrays
+        over the nodes: first particle, count, level, center, half width,
+        mass, center of mass, first child and number of children.
+        '''
+        n = len(x)
+        k = self.k
+        depth = self.depth
+        side = 1 << depth
+        ix = np.clip(((x + k) * (side / (2 * k))).astype(np.int64), 0, side - 1)
+        iy = np.clip(((y + k) * (side / (2 * k))).astype(np.int64), 0, side - 1)
+        code = spread_bits(ix).astype(np.int64) | spread_bits(iy).astype(np.int64) << 1
+        order = np.argsort(code, kind='stable')
+        code = code[order]
+        ix = ix[order]
+        iy = iy[order]
+
+        starts = []
+        counts = []
+        levels = []
+        leaves = []
+        active = np.arange(n)
+        level = 0
+        while len(active):
+            keys = code[active] >> 2 * (depth - level)
+            first = np.concatenate([[0], np.nonzero(np.diff(keys))[0] + 1])
+            start = active[first]
+            count = np.diff(np.append(first, len(active)))
+            leaf = (count <= self.leaf_size) | (level == depth)
+            starts.append(start)
+            counts.append(count)
+            levels.append(np.full(len(start), level))
+            leaves.append(leaf)
+            active = active[~np.repeat(leaf, count)]
+            level += 1
+
+        start = np.concatenate(starts)
+        count = np.concatenate(counts)
+        level = np.concatenate(levels)
+        leaf = np.concatenate(leaves)
+
+        # the children of the internal nodes of one level are the next
+        # level, in the same order
+        offsets = np.cumsum([0] + [len(a) for a in starts])
+        child_count = np.zeros(len(start), dtype=np.intp)
+        child_start = np.zeros(len(start), dtype=np.intp)
+        for a in range(len(starts) - 1):
+            lo, hi = offsets[a], offsets[a + 1]
+            inner = np.nonzero(~leaf[lo:hi])[0] + lo
+            # the first child of every inner node, found by its first particle
+            first = np.searchsorted(starts[a + 1], start[inner])
+            last = np.searchsorted(starts[a + 1], start[inner] + count[inner])
+            child_start[inner] = offsets[a + 1] + first
+            child_count[inner] = last - first
+
+        width = 2 * k / (1 << level)
+        cx = -k + ((ix[start] >> (depth - level)) + 0.5) * width
+        cy = -k + ((iy[start] >> (depth - level)) + 0.5) * width
+
+        m = mass[order]
+        cm = np.concatenate([[0], np.cumsum(m)])
+        cmx = np.concatenate([[0], np.cumsum(m * x[order])])
+        cmy = np.concatenate([[0], np.cumsum(m * y[order])])
+        node_mass = cm[start + count] - cm[start]
+        safe = np.where(node_mass != 0, node_mass, 1)
+        mx = (cmx[start + count] - cmx[start]) / safe
+        my = (cmy[start + count] - cmy[start]) / safe
+        return order, (start, count, cx, cy, width / 2, node_mass, mx, my, leaf, child_start, child_count)
+
+    def interactions(self, tree):
+        '''
+        (leaf, node) pairs to use as center of mass and (leaf, leaf) pairs
+        to sum directly.
+        '''
+        start, count, cx, cy, h, mass, mx, my, leaf, child_start, child_count = tree
+        k0 = 2 * self.k
+        theta2 = self.theta ** 2
+        targets = np.nonzero(leaf)[0]
+        t = targets
+        s = np.zeros(len(t), dtype=np.intp)
+        far = []
+        near = []
+        while len(t):
+            # nodes that are entirely past the taper from the whole leaf
+            gx = np.abs(cx[s] - cx[t])
+            gx = np.maximum(np.abs(gx - k0 * np.rint(gx / k0)) - h[s] - h[t], 0)
+            gy = np.abs(cy[s] - cy[t])
+            gy = np.maximum(np.abs(gy - k0 * np.rint(gy / k0)) - h[s] - h[t], 0)
+            keep = gx * gx + gy * gy < self.off2
+            t = t[keep]
+            s = s[keep]
+
+            # distance from the center of mass to the nearest point of the leaf
+            dx = mx[s] - cx[t]
+            dx = np.maximum(np.abs(dx - k0 * np.rint(dx / k0)) - h[t], 0)
+            dy = my[s] - cy[t]
+            dy = np.maximum(np.abs(dy - k0 * np.rint(dy / k0)) - h[t], 0)
+            r2 = dx * dx + dy * dy
+            size2 = 4 * h[s] * h[s]
+            accept = size2 < theta2 * np.minimum(r2, self.on2)
+            far.append((t[accept], s[accept]))
+
+            t = t[~accept]
+            s = s[~accept]
+            direct = leaf[s]
+            near.append((t[direct], s[direct]))
+
+            t = t[~direct]
+            s = s[~direct]
+            c = child_count[s]
+            begin = np.cumsum(c) - c
+            t = np.repeat(t, c)
+            s = np.repeat(child_start[s], c) + np.arange(c.sum()) - np.repeat(begin, c)
+        far = tuple(np.concatenate(a) for a in zip(*far))
+        near = tuple(np.concatenate(a) for a in zip(*near))
+        return far, near
+
+    def accelerations(self, x, y, mass=None, observe=False, chunk=1 << 20):
+        '''
+        Acceleration of every particle: the pair force is strength times
+        both masses (all 1 by default), divided by the mass of the particle
+        it acts on, so the others are weighted by their mass. With observe
+        it also returns the potential energy and the r.F sum of all pairs,
+        for Observables.
+        '''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        n = len(x)
+        if mass is None:
+            mass = np.ones(n)
+        k0 = 2 * self.k
+        order, tree = self.build(x, y, mass)
+        start, count, cx, cy, h, node_mass, mx, my = tree[:8]
+        xs = x[order]
+        ys = y[order]
+        ms = mass[order]
+        far, near = self.interactions(tree)
+
+        fx = np.zeros(n)
+        fy = np.zeros(n)
+        energy = 0.0
+        virial = 0.0
+
+        def add(i, px, py, pm):
+            nonlocal energy, virial
+            dx = xs[i] - px
+            dx -= k0 * np.rint(dx / k0)
+            dy = ys[i] - py
+            dy -= k0 * np.rint(dy / k0)
+            r2 = dx * dx + dy * dy
+            w = pm / (r2 + self.eps2)
+            outer = r2 > self.on2
+            w[outer] *= self.taper(r2[outer])
+            fx[:] += np.bincount(i, w * dx, n)
+            fy[:] += np.bincount(i, w * dy, n)
+            if observe:
+                # every pair is seen from both sides
+                energy += np.dot(ms[i] * pm, self.potential(r2)) / 2
+                virial += self.strength * np.dot(ms[i], w * r2) / 2
+
+        # far: every particle of the leaf with the center of mass of the node
+        t, s = far
+        per = count[t]
+        for a in range(0, len(t), max(chunk // self.leaf_size, 1)):
+            tt = t[a:a + chunk // self.leaf_size]
+            ss = s[a:a + chunk // self.leaf_size]
+            c = per[a:a + chunk // self.leaf_size]
+            begin = np.cumsum(c) - c
+            i = np.repeat(start[tt], c) + np.arange(c.sum()) - np.repeat(begin, c)
+            j = np.repeat(ss, c)
+            add(i, mx[j], my[j], node_mass[j])
+
+        # near: every particle of the leaf with every particle of the other
+        t, s = near
+        cap = max(int(count[t].max()) if len(t) else 0, 1)
+        slot = np.arange(cap)
+        step = max(chunk // (cap * cap), 1)
+        for a in range(0, len(t), step):
+            tt = t[a:a + step]
+            ss = s[a:a + step]
+            i = start[tt][:, None, None] + slot[None, :, None]
+            j = start[ss][:, None, None] + slot[None, None, :]
+            valid = (slot[None, :, None] < count[tt][:, None, None]) & \
+                    (slot[None, None, :] < count[ss][:, None, None])
+            i, j = np.broadcast_arrays(i, j)
+            valid &= i != j
+            i = i[valid]
+            j = j[valid]
+            add(i, xs[j], ys[j], ms[j])
+
+        ax = np.empty(n)
+        ay = np.empty(n)
+        ax[order] = self.strength * fx
+        ay[order] = self.strength * fy
+        if observe:
+            return ax, ay, energy, virial
+        return ax, ay
+
+def long_range_accelerations(gas, observe):
+    '''
+    gas.long_range at the positions of gas. With observe also the keyword
+    arguments for observer.pairs() with its potential energy and virial.
+    '''
+    mass = gas.mass if getattr(gas, 'mixture', None) else None
+    if not observe:
+        lx, ly = gas.long_range.accelerations(gas.x, gas.y, mass)
+        return lx, ly, {}
+    lx, ly, potential, virial = gas.long_range.accelerations(gas.x, gas.y, mass, observe=True)
+    return lx, ly, {'potential': potential, 'virial': virial}
+
+class Gas:
+    '''
+    Structure-of-arrays storage: x, y, vx and vy of all particles live in
+    numpy arrays and every step is done as batched array operations.
+    With dtype=np.float32 the state takes 16 bytes per particle, so a
+    million particles fit in 16 MB; forces are still summed in float64.
+    '''
+
+    def __init__(self, x, y, vx, vy, k, dtype=float):
+        self.x = np.array(x, dtype=dtype)
+        self.y = np.array(y, dtype=dtype)
+        self.vx = np.array(vx, dtype=dtype)
+        self.vy = np.array(vy, dtype=dtype)
+        self.k = k
+        # accelerations at the current positions, kept by verlet_step
+        self.acc = None
+        # ForceTable to use instead of the analytic force
+        self.table = None
+        # Observables fed with the pairs of the next force evaluation
+        self.observer = None
+        # BarnesHut for a long-range force on top of LJ
+        self.long_range = None
+        # NeighborList, without one all pairs are searched every step
+        self.neighbors = None
+        # Mixture and the species index of every particle, see set_mixture
+        self.mixture = None
+        self.kind = None
+        # ids[slot] is the particle stored in slot, None until reordered
+        self.ids = None
+
+    def reorder(self):
+        '''
+        Sorts the storage along a Z-order curve, so the pairs of a neighbour
+        loop touch nearly contiguous memory. Use by_id() for output.
+        '''
+        self.permute(morton_order(self.x, self.y, self.k))
+
+    def permute(self, order):
+        if self.ids is None:
+            self.ids = np.arange(len(self.x))
+        self.ids = self.ids[order]
+        self.x = self.x[order]
+        self.y = self.y[order]
+        self.vx = self.vx[order]
+        self.vy = self.vy[order]
+        if self.acc is not None:
+            self.acc = (self.acc[0][order], self.acc[1][order])
+        if self.mixture:
+            self.kind = self.kind[order]
+            self.mass = self.mass[order]
+        if self.neighbors:
+            # the stored pairs are slot numbers
+            self.neighbors.reset()
+
+    def set_mixture(self, mixture, kind):
+        self.mixture = mixture
+        self.kind = np.asarray(kind, dtype=np.intp)
+        self.mass = mixture.mass[self.kind]
+
+    def accelerations(self):
+        pairs = None
+        if self.observer is not None:
+            pairs = []
+        if self.neighbors:
+            i, j = self.neighbors.pairs(self.x, self.y, self.k)
+            ax, ay = list_accelerations(self.x, self.y, self.k, i, j, self.table, pairs,
+                                        self.mixture, self.kind)
+        else:
+            ax, ay = pair_accelerations(self.x, self.y, self.k, self.table, pairs,
+                                        mixture=self.mixture, kind=self.kind)
+        if self.mixture:
+            ax /= self.mass
+            ay /= self.mass
+        extra = {}
+        if self.long_range:
+            lx, ly, extra = long_range_accelerations(self, pairs is not None)
+            ax += lx
+            ay += ly
+        if pairs is not None:
+            i, j, dr2, rf = (np.concatenate(a) for a in zip(*pairs))
+            params = None
+            if self.mixture:
+                params = self.mixture.params(self.kind, i, j)
+            self.observer.pairs(dr2, rf, params=params, index=(i, j), **extra)
+        return ax.astype(self.x.dtype, copy=False), ay.astype(self.x.dtype, copy=False)
+
+    def accelerate(self, ax, ay, dt):
+        self.vx += ax * dt
+        self.vy += ay * dt
+
+    def move(self, dt):
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+
+    def wrap(self):
+        self.x = -self.k + (self.x + self.k) % (2 * self.k)
+        self.y = -self.k + (self.y + self.k) % (2 * self.k)
+
+def slab_arrays(buf, n):
+    '''
+    x, y, ax, ay and kind of a ParallelGas in one shared memory block.
+    '''
+    x, y, ax, ay = np.ndarray((4, n), np.float64, buf)
+    kind = np.ndarray(n, np.intp, buf, 4 * n * 8)
+    return x, y, ax, ay, kind
+
+def slab_worker(conn, name, n, slab, workers, k, table, mixture):
+    '''
+    Worker process of ParallelGas, owns one vertical slab for its whole
+    life. The positions are read from the shared block name and the
+    accelerations of the owned particles written back into it (forces
+    with a mixture), so a step only sends a short message over conn:
+    (rlist, rebuild, observe). On rebuild the slab takes the particles
+    inside it and a halo of rlist beyond both edges and keeps the pairs
+    within rlist that have an owned particle, a Verlet list of the slab;
+    between rebuilds only the forces are evaluated. With observe the
+    reply holds the pairs for the observables, weighted so that a pair
+    split between two slabs counts once in total, otherwise it is None.
+    '''
+    # a child of the main process shares its resource tracker, which
+    # unlinks the block once, so it is attached like any other
+    shm = shared_memory.SharedMemory(name)
+    x, y, ax, ay, kind = slab_arrays(shm.buf, n)
+    k0 = 2 * k
+    width = k0 / workers
+    owned = both = i = j = local_kind = None
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            rlist, rebuild, observe = message
+            try:
+                if rebuild:
+                    # distance from the left edge of the slab, going right around the box
+                    d = (x + k - slab * width) % k0
+                    owned = np.nonzero(d < width)[0]
+                    halo = np.nonzero((d >= width) & ((d < width + rlist) | (d > k0 - rlist)))[0]
+                    both = np.concatenate([owned, halo])
+                    i, j = neighbor_pairs(x[both], y[both], k, rlist)
+                    # i < j, so a pair has an owned particle if i is one
+                    keep = i < len(owned)
+                    i = i[keep]
+                    j = j[keep]
+                    if mixture:
+                        local_kind = kind[both]
+                pairs = [] if observe else None
+                sax, say = list_accelerations(x[both], y[both], k, i, j, table, pairs,
+                                              mixture, local_kind)
+                ax[owned] = sax[:len(owned)]
+                ay[owned] = say[:len(owned)]
+                reply = None
+                if observe:
+                    # one batch, possibly empty
+                    pi, pj, dr2, rf = pairs[0]
+                    weight = ((pi < len(owned)) * 1.0 + (pj < len(owned))) / 2
+                    params = None
+                    if mixture:
+                        params = mixture.params(local_kind, pi, pj)
+                    reply = (dr2, rf, weight, params, both[pi], both[pj])
+            except Exception as e:
+                reply = e
+            conn.send(reply)
+    finally:
+        del x, y, ax, ay, kind
+        shm.close()
+
+class ParallelGas(Gas):
+    '''
+    Gas with the force evaluation split over worker processes. The box is
+    cut into vertical slabs and each slab is owned by one worker process
+    for the whole run, which keeps a Verlet list of its slab and halo
+    (see slab_worker). Positions and accelerations go through shared
+    memory. Whether the lists are stale is decided here from the whole
+    gas, so all slabs rebuild together and every particle is owned by
+    exactly one of them. The integration stays in the main process.
+    '''
+
+    def __init__(self, x, y, vx, vy, k, workers, dtype=float):
+        super().__init__(x, y, vx, vy, k, dtype)
+        self.workers = workers
+        self.processes = []
+        self.conns = []
+        self.shm = None
+        self.arrays = None
+        self.shared = None
+
+    def start_pool(self):
+        '''
+        The workers are started on first use, and again if table or
+        mixture were changed, since they get them once at start.
+        '''
+        n = len(self.x)
+        if self.processes and self.shared == (self.table, self.mixture, n):
+            return
+        self.close()
+        self.shared = (self.table, self.mixture, n)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(n * 5 * 8, 1))
+        self.arrays = slab_arrays(self.shm.buf, n)
+        for slab in range(self.workers):
+            ours, theirs = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=slab_worker, daemon=True,
+                args=(theirs, self.shm.name, n, slab, self.workers, self.k, self.table, self.mixture))
+            process.start()
+            theirs.close()
+            self.processes.append(process)
+            self.conns.append(ours)
+        if self.neighbors:
+            self.neighbors.reset()
+
+    def accelerations(self):
+        self.start_pool()
+        x, y, ax, ay, kind = self.arrays
+        x[:] = self.x
+        y[:] = self.y
+        nl = self.neighbors
+        if nl:
+            rebuild = nl.stale(self.x, self.y, self.k)
+            rlist = RCUT + nl.skin
+        else:
+            rebuild = True
+            rlist = RCUT
+        if rebuild:
+            if nl:
+                nl.built(self.x, self.y)
+            if self.mixture:
+                kind[:] = self.kind
+        observe = self.observer is not None
+        for conn in self.conns:
+            conn.send((rlist, rebuild, observe))
+        seen = [conn.recv() for conn in self.conns]
+        for reply in seen:
+            if isinstance(reply, Exception):
+                raise reply
+        ax = ax.copy()
+        ay = ay.copy()
+        if self.mixture:
+            ax /= self.mass
+            ay /= self.mass
+        extra = {}
+        if self.long_range:
+            lx, ly, extra = long_range_accelerations(self, observe)
+            ax += lx
+            ay += ly
+        if observe:
+            dr2, rf, weight, params, i, j = zip(*seen)
+            if self.mixture:
+                params = tuple(np.concatenate(a) for a in zip(*params))
+            else:
+                params = None
+            self.observer.pairs(np.concatenate(dr2), np.concatenate(rf), np.concatenate(weight),
+                                params=params, index=(np.concatenate(i), np.concatenate(j)), **extra)
+        return ax.astype(self.x.dtype, copy=False), ay.astype(self.x.dtype, copy=False)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.conns = []
+        self.processes = []
+        if self.shm is not None:
+            self.arrays = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+class ParticleGas:
+    '''
+    The same interface as Gas on top of a list of Particle objects,
+    using the pure Python force loops.
+    '''
+
+    def __init__(self, particles, k, engine='cells'):
+        self.particles = particles
+        self.k = k
+        self.engine = engine
+        self.acc = None
+        self.observer = None
+        self.long_range = None
+
+    @property
+    def x(self):
+        return np.array([p.x for p in self.particles], dtype=float)
+
+    @property
+    def y(self):
+        return np.array([p.y for p in self.particles], dtype=float)
+
+    @property
+    def vx(self):
+        return np.array([p.vx for p in self.particles], dtype=float)
+
+    @property
+    def vy(self):
+        return np.array([p.vy for p in self.particles], dtype=float)
+
+    def accelerations(self):
+        pairs = None
+        if self.observer is not None:
+            pairs = []
+        if self.engine == 'direct':
+            acc = direct_accelerations(self.particles, pairs)
+        else:
+            acc = cell_accelerations(self.particles, pairs)
+        ax = [a[0] for a in acc]
+        ay = [a[1] for a in acc]
+        extra = {}
+        if self.long_range:
+            lx, ly, extra = long_range_accelerations(self, pairs is not None)
+            ax = [ax[i] + lx[i] for i in range(len(ax))]
+            ay = [ay[i] + ly[i] for i in range(len(ay))]
+        if pairs is not None:
+            pairs = np.array(pairs).reshape(-1, 2)
+            self.observer.pairs(pairs[:, 0], pairs[:, 1], **extra)
+        return ax, ay
+
+    def accelerate(self, ax, ay, dt):
+        for i in range(len(self.particles)):
+            self.particles[i].accelerate(ax[i], ay[i], dt)
+
+    def move(self, dt):
+        for i in self.particles:
+            i.move(dt)
+
+    def wrap(self):
+        for i in self.particles:
+            i.x = -self.k + (i.x + self.k) % (2 * self.k)
+            i.y = -self.k + (i.y + self.k) % (2 * self.k)
+
+class HardSphereGas:
+    '''
+    Event-driven dynamics of hard disks of the given diameter in the same
+    periodic box. Nothing is integrated: the time of the next collision
+    of every pair of neighbours and the time each disk leaves its grid
+    cell are kept in a priority queue, and run() jumps from event to
+    event. Disks move in straight lines in between, so their positions
+    are stored together with the time they were last updated. Events
+    carry the collision counters of their disks at prediction time and
+    are dropped when a counter has changed since.
+    '''
+
+    def __init__(self, x, y, vx, vy, k, diameter=10):
+        n = len(x)
+        self.k = k
+        self.sigma = diameter
+        self.time = 0
+        self.px = np.asarray(x, dtype=float).tolist()
+        self.py = np.asarray(y, dtype=float).tolist()
+        self.pvx = np.asarray(vx, dtype=float).tolist()
+        self.pvy = np.asarray(vy, dtype=float).tolist()
+        self.pt = [0] * n
+        self.count = [0] * n
+
+        # cells at least one diameter wide
+        self.m = max(1, int(2 * k // diameter))
+        self.w = 2 * k / self.m
+        self.cells = {}
+        self.cell = []
+        for i in range(n):
+            c = (int((self.px[i] + k) / self.w) % self.m, int((self.py[i] + k) / self.w) % self.m)
+            self.cell.append(c)
+            self.cells.setdefault(c, set()).add(i)
+
+        self.events = []
+        self.seq = 0
+        self.collisions = 0
+        self.virial = 0
+        for i in range(n):
+            self.predict(i, 0)
+
+        self.acc = None
+        self.observer = None
+        self.long_range = None
+
+    # reading the positions does not move the stored ones, so observing
+    # or saving the gas never changes its trajectory
+    @property
+    def x(self):
+        return np.array(self.px) + np.array(self.pvx) * (self.time - np.array(self.pt))
+
+    @property
+    def y(self):
+        return np.array(self.py) + np.array(self.pvy) * (self.time - np.array(self.pt))
+
+    @property
+    def vx(self):
+        return np.array(self.pvx)
+
+    @property
+    def vy(self):
+        return np.array(self.pvy)
+
+    def state(self):
+        '''
+        Everything run() depends on besides the velocities, as arrays for
+        a checkpoint: the stored positions with their times, the cells,
+        the collision counters and the event queue.
+        '''
+        events = np.array([e[:1] for e in self.events], dtype=float).reshape(-1)
+        tags = np.array([e[1:] for e in self.events], dtype=np.int64).reshape(-1, 5)
+        return {'hard_p': np.array([self.px, self.py, self.pt]),
+                'hard_cell': np.array(self.cell, dtype=np.int64).reshape(-1, 2),
+                'hard_count': np.array(self.count, dtype=np.int64),
+                'hard_events': events, 'hard_tags': tags,
+                'hard_clock': np.array([self.time, self.seq, self.collisions])}
+
+    def restore(self, state):
+        '''
+        Continues from state() exactly where it was saved; the velocities
+        must already be the saved ones.
+        '''
+        self.px, self.py, self.pt = (a.tolist() for a in state['hard_p'])
+        self.cell = [tuple(c) for c in state['hard_cell'].tolist()]
+        self.cells = {}
+        for i, c in enumerate(self.cell):
+            self.cells.setdefault(c, set()).add(i)
+        self.count = state['hard_count'].tolist()
+        self.events = [(t,) + tuple(tag) for t, tag in
+                       zip(state['hard_events'].tolist(), state['hard_tags'].tolist())]
+        t, seq, collisions = state['hard_clock'].tolist()
+        self.time, self.seq, self.collisions = t, int(seq), int(collisions)
+
+    def update(self, i, t):
+        self.px[i] += self.pvx[i] * (t - self.pt[i])
+        self.py[i] += self.pvy[i] * (t - self.pt[i])
+        self.pt[i] = t
+
+    def push(self, t, i, j, extra):
+        self.seq += 1
+        heapq.heappush(self.events, (t, self.seq, i, j, self.count[i], extra))
+
+    def neighbours(self, i):
+        cx, cy = self.cell[i]
+        m = self.m
+        near = set()
+        for a in (-1, 0, 1):
+            for b in (-1, 0, 1):
+                near.add(((cx + a) % m, (cy + b) % m))
+        for c in near:
+            yield from self.cells.get(c, ())
+
+    def predict(self, i, t):
+        k0 = 2 * self.k
+        xi = self.px[i] + self.pvx[i] * (t - self.pt[i])
+        yi = self.py[i] + self.pvy[i] * (t - self.pt[i])
+        for j in self.neighbours(i):
+            if j == i:
+                continue
+            dx = self.px[j] + self.pvx[j] * (t - self.pt[j]) - xi
+            dy = self.py[j] + self.pvy[j] * (t - self.pt[j]) - yi
+            dx -= k0 * round(dx / k0)
+            dy -= k0 * round(dy / k0)
+            dvx = self.pvx[j] - self.pvx[i]
+            dvy = self.pvy[j] - self.pvy[i]
+            b = dx * dvx + dy * dvy
+            if b >= 0:
+                continue
+            v2 = dvx * dvx + dvy * dvy
+            d = b * b - v2 * (dx * dx + dy * dy - self.sigma ** 2)
+            if d < 0:
+                continue
+            tc = t + max(0, (-b - math.sqrt(d)) / v2)
+            self.push(tc, i, j, self.count[j])
+
+        # leaving the cell through an x or a y wall
+        cx, cy = self.cell[i]
+        tx = ty = math.inf
+        if self.pvx[i] > 0:
+            tx = (-self.k + (cx + 1) * self.w - xi) / self.pvx[i]
+        elif self.pvx[i] < 0:
+            tx = (-self.k + cx * self.w - xi) / self.pvx[i]
+        if self.pvy[i] > 0:
+            ty = (-self.k + (cy + 1) * self.w - yi) / self.pvy[i]
+        elif self.pvy[i] < 0:
+            ty = (-self.k + cy * self.w - yi) / self.pvy[i]
+        if tx < ty:
+            self.push(t + max(0, tx), i, -1, 1 if self.pvx[i] > 0 else -1)
+        elif ty < math.inf:
+            self.push(t + max(0, ty), i, -2, 1 if self.pvy[i] > 0 else -1)
+
+    def collide(self, i, j, t):
+        k0 = 2 * self.k
+        self.update(i, t)
+        self.update(j, t)
+        dx = self.px[j] - self.px[i]
+        dy = self.py[j] - self.py[i]
+        dx -= k0 * round(dx / k0)
+        dy -= k0 * round(dy / k0)
+        b = dx * (self.pvx[j] - self.pvx[i]) + dy * (self.pvy[j] - self.pvy[i])
+        # equal masses: swap the velocity components along the line of centers
+        J = b / (dx * dx + dy * dy)
+        self.pvx[i] += J * dx
+        self.pvy[i] += J * dy
+        self.pvx[j] -= J * dx
+        self.pvy[j] -= J * dy
+        self.virial -= b
+        self.collisions += 1
+        self.count[i] += 1
+        self.count[j] += 1
+        self.predict(i, t)
+        self.predict(j, t)
+
+    def cross(self, i, axis, direction, t):
+        self.update(i, t)
+        old = self.cell[i]
+        c = list(old)
+        c[axis] += direction
+        # leaving the box: wrap the coordinate with the cell
+        if c[axis] == self.m or c[axis] == -1:
+            c[axis] %= self.m
+            if axis == 0:
+                self.px[i] -= direction * 2 * self.k
+            else:
+                self.py[i] -= direction * 2 * self.k
+        c = tuple(c)
+        self.cells[old].discard(i)
+        self.cells.setdefault(c, set()).add(i)
+        self.cell[i] = c
+        self.predict(i, t)
+
+    def run(self, t_end):
+        start = self.time
+        self.virial = 0
+        while self.events and self.events[0][0] <= t_end:
+            t, seq, i, j, ci, extra = heapq.heappop(self.events)
+            if ci != self.count[i]:
+                continue
+            if j >= 0:
+                if extra == self.count[j]:
+                    self.collide(i, j, t)
+            else:
+                self.cross(i, -1 - j, extra, t)
+        self.time = t_end
+
+        if self.observer is not None:
+            # time average of the collision r.F over the interval
+            self.observer.pairs(np.empty(0), np.empty(0), None, self.virial / (t_end - start))
+
+def event_step(gas, dt):
+    gas.run(gas.time + dt)
+
+def stepper(engine, integrator):
+    '''
+    The step function of an engine: the event loop of 'hard', which has
+    no forces to integrate, otherwise the integrator.
+    '''
+    if engine == 'hard':
+        return event_step
+    return INTEGRATORS[integrator]
+
+def euler_step(gas, dt):
+    if gas.acc is None:
+        gas.acc = gas.accelerations()
+    ax, ay = gas.acc
+    gas.accelerate(ax, ay, dt)
+    gas.move(dt)
+    gas.wrap()
+    gas.acc = None
+
+def verlet_step(gas, dt):
+    '''
+    Velocity Verlet: half kick, drift, new forces, half kick. Symplectic,
+    so the energy stays bounded with a much larger dt than euler_step.
+    '''
+    if gas.acc is None:
+        gas.acc = gas.accelerations()
+    ax, ay = gas.acc
+    gas.accelerate(ax, ay, dt / 2)
+    gas.move(dt)
+    gas.wrap()
+    gas.acc = gas.accelerations()
+    ax, ay = gas.acc
+    gas.accelerate(ax, ay, dt / 2)
+
+INTEGRATORS = {'euler': euler_step, 'verlet': verlet_step}
+
+class AdaptiveStep:
+    '''
+    Wraps an integrator and picks dt every step so that no particle moves
+    more than max_move, neither from its speed (v dt) nor from its
+    acceleration (a dt ** 2 / 2). dt changes by at most a factor grow per
+    step and stays between dt_min and dt_max. Called like an integrator,
+    the dt passed in is the one of the previous step and the new one is
+    left in self.dt.
+    '''
+
+    def __init__(self, advance, dt_min, dt_max, max_move=0.5, grow=1.2):
+        self.advance = advance
+        self.dt_min = dt_min
+        self.dt_max = dt_max
+        self.max_move = max_move
+        self.grow = grow
+        self.dt = None
+
+    def choose(self, gas, dt):
+        if gas.acc is None:
+            gas.acc = gas.accelerations()
+        ax, ay = gas.acc
+        vmax = np.sqrt(np.max(gas.vx ** 2 + gas.vy ** 2))
+        amax = np.sqrt(np.max(np.square(ax) + np.square(ay)))
+
+        limit = self.dt_max
+        if vmax > 0:
+            limit = min(limit, self.max_move / vmax)
+        if amax > 0:
+            limit = min(limit, math.sqrt(2 * self.max_move / amax))
+
+        limit = min(max(limit, dt / self.grow), dt * self.grow)
+        return min(max(limit, self.dt_min), self.dt_max)
+
+    def __call__(self, gas, dt):
+        self.dt = self.choose(gas, dt)
+        self.advance(gas, self.dt)
+
+TRAJ_MAGIC = b'GASTRAJ2'
+# files from before frames had their simulated time, still readable
+TRAJ_MAGIC_UNTIMED = b'GASTRAJ1'
+# magic, N, quantized, every, k, dt, frames written; padded to 64 bytes
+TRAJ_HEADER = struct.Struct('<8sqqqddq')
+TRAJ_HEADER_SIZE = 64
+
+def frame_dtype(n, quantized, timed=True):
+    '''
+    One trajectory frame: step, simulated time (not in untimed files) and
+    x, y, vx, vy for all particles. Quantized frames keep positions as
+    16 bit fractions of the box and velocities as 16 bit fractions of the
+    largest speed component in that frame.
+    '''
+    head = [('step', '<i8')]
+    if timed:
+        head.append(('time', '<f8'))
+    if quantized:
+        return np.dtype(head + [('scale', '<f4'), ('q', '<i2', (4, n))])
+    return np.dtype(head + [('data', '<f4', (4, n))])
+
+class TrajectoryWriter:
+    '''
+    Appends frames to a preallocated memory-mapped file. write() only
+    copies the arrays into a queue, a background thread does the encoding
+    and the copy into the map, so the integrator does not wait for disk.
+    The file grows by doubling when the preallocated frames run out. An
+    error in the thread (a full disk) is raised again by the next write()
+    or by close(). With resume_step an existing file is continued: its
+    frames from resume_step on are dropped, they are written again.
+    '''
+
+    def __init__(self, path, n, k, dt, every, quantized=False, capacity=1024, resume_step=None):
+        self.path = path
+        self.n = n
+        self.k = k
+        self.quantized = quantized
+        self.dtype = frame_dtype(n, quantized)
+        self.frames = 0
+        self.capacity = 0
+        self.map = None
+        self.error = None
+
+        if resume_step is not None and os.path.exists(path):
+            old = Trajectory(path)
+            if (old.n, old.quantized, old.every, old.timed) != (n, bool(quantized), every, True):
+                raise ValueError('%s was written with other -n, --traj-quantize or --traj-every, '
+                                 'or by an older version' % path)
+            self.frames = int(np.searchsorted(old.steps, resume_step))
+            old = None
+        else:
+            with open(path, 'wb') as f:
+                f.write(TRAJ_HEADER.pack(TRAJ_MAGIC, n, quantized, every, k, dt, 0).ljust(TRAJ_HEADER_SIZE, b'\0'))
+        self.grow(max(capacity, 2 * self.frames))
+        self.count()
+
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def grow(self, capacity):
+        self.map = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(TRAJ_HEADER_SIZE + capacity * self.dtype.itemsize)
+        self.map = np.memmap(self.path, dtype=np.uint8, mode='r+')
+        self.header = self.map[:TRAJ_HEADER_SIZE]
+        self.data = self.map[TRAJ_HEADER_SIZE:].view(self.dtype)
+        self.capacity = capacity
+
+    def count(self):
+        self.header[TRAJ_HEADER.size - 8:TRAJ_HEADER.size] = np.frombuffer(struct.pack('<q', self.frames), np.uint8)
+
+    def write(self, step, gas, sim_time):
+        if self.error:
+            raise self.error
+        self.queue.put((step, sim_time, by_id(gas, np.stack([gas.x, gas.y, gas.vx, gas.vy]))))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error:
+                # keep emptying the queue so write() never blocks
+                continue
+            try:
+                self.store(*item)
+            except Exception as e:
+                self.error = e
+
+    def store(self, step, sim_time, frame):
+        if self.frames == self.capacity:
+            self.map.flush()
+            self.grow(2 * self.capacity)
+
+        record = self.data[self.frames]
+        record['step'] = step
+        record['time'] = sim_time
+        if self.quantized:
+            position = (frame[:2] + self.k) / (2 * self.k) * 65535 - 32768
+            scale = max(np.abs(frame[2:]).max(), 1e-30)
+            record['scale'] = scale
+            record['q'][:2] = np.clip(np.rint(position), -32768, 32767)
+            record['q'][2:] = np.rint(frame[2:] / scale * 32767)
+        else:
+            record['data'] = frame
+
+        self.frames += 1
+        self.count()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.map is not None:
+            self.map.flush()
+        self.map = None
+        self.data = None
+        self.header = None
+        if self.error:
+            raise self.error
+
+class Trajectory:
+    '''
+    Reader for files made by TrajectoryWriter. The frames are memory-mapped,
+    traj[i] decodes a single frame into a (4, N) float array of
+    x, y, vx, vy, so runs larger than RAM can be walked frame by frame.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, n, quantized, every, k, dt, frames = TRAJ_HEADER.unpack(f.read(TRAJ_HEADER.size))
+        if magic not in (TRAJ_MAGIC, TRAJ_MAGIC_UNTIMED):
+            raise ValueError(path + ' is not a gas trajectory')
+        self.n = n
+        self.quantized = bool(quantized)
+        self.every = every
+        self.k = k
+        self.dt = dt
+        self.timed = magic == TRAJ_MAGIC
+        self.frames = np.memmap(path, dtype=frame_dtype(n, quantized, self.timed), mode='r',
+                                offset=TRAJ_HEADER_SIZE, shape=(frames,))
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def steps(self):
+        return self.frames['step']
+
+    @property
+    def times(self):
+        '''
+        Simulated time of every frame; older files only know the first dt.
+        '''
+        if self.timed:
+            return self.frames['time']
+        return self.steps * self.dt
+
+    def __getitem__(self, i):
+        return self.read(i, i + 1)[0]
+
+    def read(self, start, stop):
+        '''
+        Frames start to stop decoded at once, a (frames, 4, N) array.
+        '''
+        records = self.frames[start:stop]
+        if not self.quantized:
+            return records['data'].astype(float)
+        q = records['q'].astype(float)
+        frames = np.empty(q.shape)
+        frames[:, :2] = (q[:, :2] + 32768) / 65535 * (2 * self.k) - self.k
+        frames[:, 2:] = q[:, 2:] / 32767 * records['scale'][:, None, None]
+        return frames
+
+def unwrapped_chunks(traj, chunk):
+    '''
+    Yields (positions, velocities) of chunk frames at a time, both
+    (frames, 2, N), with the positions unwrapped: an image counter per
+    particle and axis is moved by one box whenever a particle jumps by
+    more than half a box between two frames. Frames must be written often
+    enough that nothing really moves that far in between.
+    '''
+    k0 = 2 * traj.k
+    image = np.zeros((2, traj.n))
+    # r0 is subtracted so the numbers stay small
+    origin = traj[0][:2]
+    last = None
+    for start in range(0, len(traj), chunk):
+        frames = traj.read(start, start + chunk)
+        wrapped = frames[:, :2]
+        if last is None:
+            last = wrapped[0]
+        steps = np.diff(wrapped, axis=0, prepend=last[None])
+        crossings = np.cumsum(np.rint(steps / k0), axis=0)
+        yield wrapped - k0 * (crossings + image) - origin, frames[:, 2:]
+        image += crossings[-1]
+        last = wrapped[-1]
+
+class Correlator:
+    '''
+    sum over t of a(t) . b(t + lag) for lag < lags, for a long series
+    that arrives in chunks. Each block of origins is correlated with
+    itself and the next lags - 1 frames by zero-padded FFT, so memory is
+    (block + lags) frames whatever the length of the series. With
+    squares it also sums |a(t)| ** 2 + |a(t + lag)| ** 2, for the mean
+    squared displacement. counts[lag] is the number of origins.
+    '''
+
+    def __init__(self, lags, block, squares=False):
+        self.lags = lags
+        self.block = block
+        self.squares = squares
+        self.cross = np.zeros(lags)
+        self.square = np.zeros(lags)
+        self.counts = np.zeros(lags)
+        self.pending = None
+
+    def add(self, frames, final=False):
+        if self.pending is None:
+            self.pending = frames
+        else:
+            self.pending = np.concatenate([self.pending, frames])
+        need = self.block + self.lags - 1
+        while len(self.pending) >= need or (final and len(self.pending)):
+            self.correlate(self.pending[:self.block], self.pending[:need])
+            self.pending = self.pending[self.block:]
+
+    def correlate(self, origins, partners):
+        b = len(origins)
+        size = 1 << int(max(b + len(partners) - 1, self.lags)).bit_length()
+        fa = np.fft.rfft(origins.reshape(b, -1), size, axis=0)
+        fb = np.fft.rfft(partners.reshape(len(partners), -1), size, axis=0)
+        cross = np.fft.irfft((fa.conj() * fb).sum(axis=1), size)
+
+        lag = np.arange(self.lags)
+        m = np.clip(np.minimum(b, len(partners) - lag), 0, None)
+        self.cross += cross[:self.lags] * (m > 0)
+        self.counts += m
+        if self.squares:
+            sa = np.concatenate([[0], np.cumsum((origins ** 2).reshape(b, -1).sum(axis=1))])
+            sb = np.concatenate([[0], np.cumsum((partners ** 2).reshape(len(partners), -1).sum(axis=1))])
+            tail = np.minimum(lag + m, len(partners))
+            self.square += sa[m] + sb[tail] - sb[np.minimum(lag, len(partners))]
+
+    def mean(self, n):
+        counts = np.maximum(self.counts, 1) * n
+        if self.squares:
+            return (self.square - 2 * self.cross) / counts
+        return self.cross / counts
+
+def analyse_trajectory(path, out_path, lags=None, chunk=256):
+    '''
+    Mean squared displacement and velocity autocorrelation of a trajectory
+    file, averaged over all particles and time origins up to lags frames
+    apart (default a quarter of the run, at most 1024), written as CSV. Returns the
+    diffusion coefficient from the MSD slope over the second half of the
+    lags and from the integral of the VACF (MSD = 4 D t in 2D). The
+    frames must be evenly spaced in time, which runs with --adaptive are
+    not.
+    '''
+    traj = Trajectory(path)
+    if len(traj) < 3:
+        raise SystemExit(path + ' has fewer than three frames, too few for an MSD slope')
+    if lags is None:
+        lags = min(max(len(traj) // 4, 3), 1024)
+    lags = min(lags, len(traj))
+    # the slope is fitted to lags - lags // 2 points
+    if lags < 3:
+        raise SystemExit('the MSD slope needs at least 3 lags, got %d' % lags)
+    times = np.asarray(traj.times, dtype=float)
+    spacing = np.diff(times)
+    if not np.allclose(spacing, spacing[0], rtol=1e-6, atol=0):
+        raise SystemExit('%s has frames %.6g to %.6g apart in time; the correlations need '
+                         'evenly spaced frames, rerun without --adaptive'
+                         % (path, spacing.min(), spacing.max()))
+    block = max(chunk, lags)
+
+    msd = Correlator(lags, block, squares=True)
+    vacf = Correlator(lags, block)
+    for positions, velocities in unwrapped_chunks(traj, chunk):
+        msd.add(positions)
+        vacf.add(velocities)
+    msd.add(np.empty((0, 2, traj.n)), final=True)
+    vacf.add(np.empty((0, 2, traj.n)), final=True)
+
+    frame_time = spacing[0]
+    time = np.arange(lags) * frame_time
+    msd = msd.mean(traj.n)
+    vacf = vacf.mean(traj.n)
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'msd', 'vacf'])
+        writer.writerows(zip(time, msd, vacf))
+
+    half = lags // 2
+    slope = np.polyfit(time[half:], msd[half:], 1)[0]
+    integral = frame_time * (vacf.sum() - (vacf[0] + vacf[-1]) / 2)
+    return {'D_msd': slope / 4, 'D_vacf': integral / 2}
+
+def lj_potential(dr2, sigma2=R0 * R0, epsilon=1):
+    s6 = (sigma2 / dr2) ** 3
+    return epsilon * (s6 * s6 - s6)
+
+class Observables:
+    '''
+    Kinetic temperature, virial pressure, potential and total energy and
+    the radial distribution function g(r), built from the pairs the force
+    loop has already found, so there is no second pass over the pairs.
+    The engine calls pairs() on every force evaluation while gas.observer
+    is set, sample() turns the last of them into a row of the time series.
+    Rows (see COLUMNS) are appended to path as raw float64, read them back
+    with np.fromfile(path).reshape(-1, len(Observables.COLUMNS)).
+    '''
+
+    COLUMNS = ('step', 'temperature', 'pressure', 'potential', 'energy', 'time')
+
+    def __init__(self, path, n, k, every, bins=100):
+        self.path = path
+        self.n = n
+        self.k = k
+        self.every = every
+        self.edges = np.linspace(0, RCUT, bins + 1)
+        self.hist = np.zeros(bins)
+        self.samples = 0
+        self.last = None
+        self.file = open(path, 'wb') if path else None
+
+    def pairs(self, dr2, rf, weight=None, virial=0, params=None, index=None, potential=0):
+        '''
+        virial is a r.F sum and potential an energy that do not come from
+        the LJ pairs: the collision impulses of the hard-sphere engine, the
+        long-range force. params is (epsilon, sigma ** 2) of every pair in
+        a Mixture. index is (i, j) of the pairs, from the numpy engines
+        only, Observables does not need it.
+        '''
+        self.last = (dr2, rf, weight, virial, params, potential)
+
+    def sample(self, step, gas, sim_time=np.nan):
+        dr2, rf, weight, virial, params, extra = self.last
+        if weight is None:
+            weight = np.ones(len(dr2))
+        self.hist += np.histogram(np.sqrt(dr2), self.edges, weights=weight)[0]
+        self.samples += 1
+
+        n = self.n
+        area = (2 * self.k) ** 2
+        if getattr(gas, 'mixture', None):
+            kinetic = 0.5 * np.dot(gas.mass, gas.vx * gas.vx + gas.vy * gas.vy)
+        else:
+            kinetic = 0.5 * (np.dot(gas.vx, gas.vx) + np.dot(gas.vy, gas.vy))
+        # two degrees of freedom per particle, kB = 1
+        temperature = kinetic / n
+        pressure = (n * temperature + 0.5 * (np.dot(weight, rf) + virial)) / area
+        if params is None:
+            potential = np.dot(weight, lj_potential(dr2)) + extra
+        else:
+            potential = np.dot(weight, lj_potential(dr2, params[1], params[0])) + extra
+
+        row = np.array([step, temperature, pressure, potential, kinetic + potential, sim_time])
+        if self.file:
+            self.file.write(row.tobytes())
+        return row
+
+    def rdf(self):
+        '''
+        g(r) at the bin centers, averaged over all samples so far.
+        '''
+        shell = np.pi * (self.edges[1:] ** 2 - self.edges[:-1] ** 2)
+        ideal = self.samples * self.n * (self.n - 1) / 2 * shell / (2 * self.k) ** 2
+        return (self.edges[1:] + self.edges[:-1]) / 2, self.hist / np.maximum(ideal, 1e-300)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            r, g = self.rdf()
+            np.save(self.path + '.rdf.npy', np.stack([r, g]))
+
+class Clusters:
+    '''
+    Cluster size distribution for spotting droplets: two particles are
+    bonded when they are closer than bond, a cluster is a connected group
+    of bonded particles. Uses the (i, j) pairs the force loop of a numpy
+    engine has already found (so bond must not exceed RCUT) and a
+    vectorized union-find: every round hooks the larger root of each
+    bonded pair under the smaller one and then halves paths until every
+    particle points at its root. One JSON line per sample is written to
+    path: step, simulated time, number of clusters, largest cluster and
+    {size: count}.
+    '''
+
+    def __init__(self, path, n, every, bond=1.5 * R0):
+        if bond > RCUT:
+            raise ValueError('bond must not be longer than the cutoff RCUT = %s' % RCUT)
+        self.n = n
+        self.every = every
+        self.bond2 = bond * bond
+        self.last = None
+        self.file = open(path, 'w') if path else None
+
+    def pairs(self, dr2, rf, weight=None, virial=0, params=None, index=None, potential=0):
+        if index is None:
+            raise ValueError('cluster detection needs the pair indices of a numpy engine')
+        bonded = dr2 < self.bond2
+        self.last = (index[0][bonded], index[1][bonded])
+
+    def labels(self, i, j):
+        '''
+        Root of every particle, the smallest index in its cluster.
+        '''
+        parent = np.arange(self.n)
+        while True:
+            a = parent[i]
+            b = parent[j]
+            join = a != b
+            if not join.any():
+                return parent
+            np.minimum.at(parent, np.maximum(a[join], b[join]), np.minimum(a[join], b[join]))
+            while True:
+                grand = parent[parent]
+                if np.array_equal(grand, parent):
+                    break
+                parent = grand
+
+    def sample(self, step, gas, sim_time=None):
+        sizes = np.bincount(self.labels(*self.last), minlength=self.n)
+        sizes = sizes[sizes > 0]
+        size, count = np.unique(sizes, return_counts=True)
+        row = {'step': step, 'time': sim_time, 'clusters': len(sizes), 'largest': int(sizes.max()),
+               'distribution': {int(s): int(c) for s, c in zip(size, count)}}
+        if self.file:
+            self.file.write(json.dumps(row) + '\n')
+        return row
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+class Observers:
+    '''
+    Passes the pairs of a force evaluation on to several observers.
+    '''
+
+    def __init__(self, observers):
+        self.observers = observers
+
+    def pairs(self, *args, **kwargs):
+        for observer in self.observers:
+            observer.pairs(*args, **kwargs)
+
+def save_checkpoint(path, gas, step, dt, sim_time):
+    '''
+    Writes the whole state to a temporary file and renames it over path,
+    so a crash while writing leaves the previous checkpoint intact.
+    '''
+    version, state, gauss = getstate()
+    extra = {}
+    if getattr(gas, 'mixture', None):
+        extra['kind'] = by_id(gas, gas.kind)
+        # the species themselves, so a resume with other ones is refused
+        extra['species_mass'] = gas.mixture.mass
+        extra['species_epsilon'] = gas.mixture.epsilon
+        extra['species_sigma2'] = gas.mixture.sigma2
+    if getattr(gas, 'ids', None) is not None:
+        # the storage order, so a resumed run sums the forces in the same order
+        extra['ids'] = gas.ids
+    if isinstance(gas, HardSphereGas):
+        extra.update(gas.state())
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, state=by_id(gas, np.stack([gas.x, gas.y, gas.vx, gas.vy])),
+                 k=gas.k, dt=dt, step=step, time=sim_time, **extra,
+                 rng_version=version, rng_state=np.array(state, dtype=np.uint32),
+                 rng_gauss=np.nan if gauss is None else gauss)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load_checkpoint(path):
+    '''
+    Reads a file written by save_checkpoint and restores the state of
+    the random module. Returns (x, y, vx, vy, k, dt, step, kind, ids,
+    time, hard, species), kind is None unless the gas was a mixture, ids
+    is None unless it was reordered (pass it to Gas.permute); time is the
+    simulated time, which differs from step * dt with --adaptive. hard is
+    None unless the gas was a HardSphereGas (pass it to restore). species
+    is (mass, epsilon, sigma2) of the Mixture, None without one or from
+    older files.
+    '''
+    with np.load(path) as f:
+        gauss = float(f['rng_gauss'])
+        setstate((int(f['rng_version']), tuple(int(i) for i in f['rng_state']),
+                  None if math.isnan(gauss) else gauss))
+        x, y, vx, vy = f['state'].tolist()
+        kind = f['kind'] if 'kind' in f else None
+        ids = f['ids'] if 'ids' in f else None
+        step = int(f['step'])
+        sim_time = float(f['time']) if 'time' in f else step * float(f['dt'])
+        hard = None
+        if 'hard_p' in f:
+            hard = {name: f[name] for name in f.files if name.startswith('hard_')}
+        species = None
+        if 'species_mass' in f:
+            species = (f['species_mass'], f['species_epsilon'], f['species_sigma2'])
+        return x, y, vx, vy, float(f['k']), float(f['dt']), step, kind, ids, sim_time, hard, species
+
+def place_particles(N, rmin=15):
+    '''
+    Jittered grid: the box is split into m x m sites with spacing a,
+    N different sites are picked at random and every particle is moved
+    by up to (a - rmin) / 2 in each direction. Two particles are then
+    never closer than rmin, also across the periodic border, and the
+    whole thing is a few array operations instead of rejection sampling.
+    '''
+    m = math.ceil(math.sqrt(N))
+    a = 2 * k / m
+    if a < rmin:
+        raise ValueError('%d particles do not fit in a box of %g with gaps of %g' % (N, 2 * k, rmin))
+    jitter = (a - rmin) / 2
+
+    rng = np.random.default_rng(getrandbits(64))
+    sites = rng.choice(m * m, N, replace=False)
+    xs = -k + a * (sites % m + 0.5) + rng.uniform(-jitter, jitter, N)
+    ys = -k + a * (sites // m + 0.5) + rng.uniform(-jitter, jitter, N)
+    return xs, ys
+
+class Profiler:
+    '''
+    Named phase timers for the main loop. attach() replaces the force,
+    integration and wrapping methods of one gas object by timed versions
+    and wrap() times any other function, so when profiling is off nothing
+    is wrapped and the loop pays nothing. end_step() keeps the wall time
+    of the last `history` steps in a ring buffer and every `every` steps
+    prints where the time went since the previous summary.
+    '''
+
+    def __init__(self, out=sys.stderr, every=1000, history=1024):
+        self.out = out
+        self.every = every
+        self.ring = np.zeros(history)
+        self.steps = 0
+        self.totals = {}
+        # totals of all earlier reports, for Metrics
+        self.seconds = {}
+        self.last = time.perf_counter()
+        self.since = self.last
+
+    def wrap(self, name, fn):
+        totals = self.totals
+        totals.setdefault(name, 0)
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                totals[name] += clock() - start
+        return timed
+
+    def attach(self, gas):
+        if isinstance(gas, HardSphereGas):
+            gas.run = self.wrap('events', gas.run)
+            return
+        gas.accelerations = self.wrap('force', gas.accelerations)
+        gas.accelerate = self.wrap('integrate', gas.accelerate)
+        gas.move = self.wrap('integrate', gas.move)
+        gas.wrap = self.wrap('wrap', gas.wrap)
+
+    def end_step(self):
+        now = time.perf_counter()
+        self.ring[self.steps % len(self.ring)] = now - self.last
+        self.last = now
+        self.steps += 1
+        if self.steps % self.every == 0:
+            self.report()
+
+    def report(self):
+        now = time.perf_counter()
+        elapsed = now - self.since
+        self.since = now
+        recent = self.ring[:min(self.steps, len(self.ring))]
+
+        line = 'step %d: %.1f steps/s, step median %.3f ms p95 %.3f ms |' % (
+            self.steps, self.every / elapsed,
+            np.median(recent) * 1e3, np.percentile(recent, 95) * 1e3)
+        rest = elapsed
+        for name in self.totals:
+            line += ' %s %.1f%%' % (name, 100 * self.totals[name] / elapsed)
+            rest -= self.totals[name]
+            self.seconds[name] = self.seconds.get(name, 0) + self.totals[name]
+            self.totals[name] = 0
+        line += ' other %.1f%%' % (100 * rest / elapsed)
+        print(line, file=self.out, flush=True)
+
+class Metrics:
+    '''
+    Live numbers of a run for serve_metrics. The main loop calls tick()
+    every step, which is one clock read and a couple of assignments;
+    steps/s is updated about once per window seconds. The latest
+    Observables row and the Profiler phase times are only read when a
+    request comes in.
+    '''
+
+    def __init__(self, n, profiler=None, step=0, window=1.0):
+        self.n = n
+        self.profiler = profiler
+        self.window = window
+        self.step = step
+        self.rate = 0.0
+        self.mark = (step, time.perf_counter())
+        self.row = None
+
+    def tick(self, step):
+        self.step = step
+        now = time.perf_counter()
+        start, then = self.mark
+        if now - then >= self.window:
+            self.rate = (step - start) / (now - then)
+            self.mark = (step, now)
+
+    def observe(self, row):
+        self.row = row
+
+    def snapshot(self):
+        data = {'particles': self.n, 'step': self.step, 'steps_per_sec': self.rate}
+        if self.row is not None:
+            row = dict(zip(Observables.COLUMNS, self.row.tolist()))
+            data['observed_step'] = int(row.pop('step'))
+            data.update(row)
+        if self.profiler:
+            prof = self.profiler
+            data['phase_seconds'] = {name: prof.seconds.get(name, 0) + prof.totals[name]
+                                     for name in list(prof.totals)}
+        return data
+
+    def prometheus(self):
+        data = self.snapshot()
+        lines = []
+        for name, value in data.items():
+            if name == 'phase_seconds':
+                lines.append('# TYPE gas_phase_seconds_total counter')
+                for phase, seconds in value.items():
+                    lines.append('gas_phase_seconds_total{phase="%s"} %r' % (phase, seconds))
+            else:
+                lines.append('# TYPE gas_%s gauge' % name)
+                lines.append('gas_%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+async def metrics_request(metrics, reader, writer):
+    '''
+    One HTTP/1.0 exchange: /metrics gives Prometheus text, / and
+    /metrics.json give JSON.
+    '''
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.split()
+        path = parts[1].decode('latin-1') if len(parts) > 1 else '/'
+        if path == '/metrics':
+            status, kind, body = '200 OK', 'text/plain; version=0.0.4', metrics.prometheus()
+        elif path in ('/', '/metrics.json'):
+            status, kind, body = '200 OK', 'application/json', json.dumps(metrics.snapshot())
+        else:
+            status, kind, body = '404 Not Found', 'text/plain', 'not found\n'
+        body = body.encode()
+        writer.write(('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n'
+                      % (status, kind, len(body))).encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+def serve_metrics(metrics, port, host='127.0.0.1'):
+    '''
+    Serves metrics over HTTP from an asyncio loop in a daemon thread, so
+    the main loop never waits for a client. Returns the bound port (port
+    0 picks a free one).
+    '''
+    started = queue.Queue()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        try:
+            server = loop.run_until_complete(asyncio.start_server(
+                functools.partial(metrics_request, metrics), host, port))
+        except OSError as e:
+            started.put(e)
+            return
+        started.put(server.sockets[0].getsockname()[1])
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    result = started.get()
+    if isinstance(result, OSError):
+        raise SystemExit('metrics endpoint on %s:%s: %s' % (host, port, result))
+    return result
+
+def make_gas(engine, xs, ys, vxs, vys, k, workers=1, draw=False, dtype=float, skin=20):
+    '''
+    Returns (gas, turtles) for one of the engines, turtles is None if
+    draw is off. dtype is the storage type of the numpy engines. The
+    numpy engines get a NeighborList with this skin, 0 searches all pairs
+    every step; ParallelGas keeps one per slab in its workers.
+    '''
+    N = len(xs)
+    turtles = None
+    if engine == 'hard':
+        gas = HardSphereGas(xs, ys, vxs, vys, k)
+    elif workers > 1:
+        gas = ParallelGas(xs, ys, vxs, vys, k, workers, dtype)
+    elif engine == 'numpy':
+        gas = Gas(xs, ys, vxs, vys, k, dtype)
+    else:
+        # plain floats, Particle arithmetic on numpy scalars is slow
+        xs, ys, vxs, vys = (np.asarray(a, dtype=float).tolist() for a in (xs, ys, vxs, vys))
+        particles = [Particle(xs[i], ys[i], vxs[i], vys[i], draw) for i in range(N)]
+        gas = ParticleGas(particles, k, engine)
+        if draw:
+            turtles = [p.drawParticle for p in particles]
+    if draw and turtles is None:
+        turtles = [make_turtle(xs[i], ys[i]) for i in range(N)]
+    if isinstance(gas, Gas):
+        gas.table = FORCE_TABLE
+    if skin > 0 and isinstance(gas, Gas):
+        gas.neighbors = NeighborList(skin)
+    return gas, turtles
+
+def bench_energy(gas, obs, step):
+    '''
+    Total energy of gas through obs. Hard disks have no potential energy,
+    only the kinetic part is left.
+    '''
+    if isinstance(gas, HardSphereGas):
+        obs.pairs(np.empty(0), np.empty(0))
+    else:
+        gas.observer = obs
+        gas.accelerations()
+        gas.observer = None
+    return obs.sample(step, gas)[4]
+
+def bench_case(engine, N, density, integrator, dt, steps, budget, speed):
+    '''
+    One benchmark run: places N particles at the given density, then
+    steps until steps are done or budget seconds are used up. The phases
+    of the timed steps are measured with a Profiler, <phase>_sec is the
+    mean time per step spent in each of them.
+    '''
+    global k
+    k = math.sqrt(N / density) / 2
+
+    start = time.perf_counter()
+    xs, ys = place_particles(N)
+    vxs = [uniform(-speed, speed) for i in range(N)]
+    vys = [uniform(-speed, speed) for i in range(N)]
+    gas, turtles = make_gas(engine, xs, ys, vxs, vys, k)
+    setup = time.perf_counter() - start
+
+    # energy at the start and at the end, outside of the timed loop
+    obs = Observables(None, N, k, 1)
+    energy = bench_energy(gas, obs, 0)
+
+    advance = stepper(engine, integrator)
+    prof = Profiler(None)
+    prof.attach(gas)
+    done = 0
+    start = time.perf_counter()
+    while done < steps and time.perf_counter() - start < budget:
+        advance(gas, dt)
+        done += 1
+    elapsed = time.perf_counter() - start
+    phases = dict(prof.totals)
+
+    drift = (bench_energy(gas, obs, done) - energy) / abs(energy)
+    if isinstance(gas, ParallelGas):
+        gas.close()
+
+    per_step = elapsed / done
+    row = {
+        'engine': engine, 'n': N, 'density': density, 'box': 2 * k,
+        'integrator': integrator, 'dt': dt, 'steps': done,
+        'steps_per_sec': 1 / per_step,
+        'setup_sec': setup,
+    }
+    for name, seconds in phases.items():
+        row[name + '_sec'] = seconds / done
+        per_step -= seconds / done
+    row['other_sec'] = max(per_step, 0)
+    row['energy_drift'] = drift
+    return row
+
+def benchmark(path, sizes, densities, engines, integrator='verlet', dt=0.001,
+              steps=100, budget=10, speed=100):
+    '''
+    Sweeps N, density and engine headless and writes the results to path
+    as JSON. An engine is dropped for bigger N once a step at the next
+    size would take longer than the whole budget. The step time is
+    extrapolated with the scaling seen between the last two sizes
+    (quadratic until there are two sizes).
+    '''
+    results = []
+    sizes = sorted(sizes)
+    for engine in engines:
+        for density in densities:
+            power = 2
+            for a in range(len(sizes)):
+                N = sizes[a]
+                row = bench_case(engine, N, density, integrator, dt, steps, budget, speed)
+                results.append(row)
+                phases = '  '.join('%s %.4fs' % (name[:-4], value) for name, value in row.items()
+                                   if name.endswith('_sec') and name not in ('setup_sec', 'steps_per_sec'))
+                print('%-6s N=%-7d density=%-8.2g %10.1f steps/s  %s  drift %+.2e'
+                      % (engine, N, density, row['steps_per_sec'], phases, row['energy_drift']))
+
+                if a > 0:
+                    previous = results[-2]['steps_per_sec'] / row['steps_per_sec']
+                    power = min(max(math.log(previous) / math.log(N / sizes[a - 1]), 1), 2)
+                if a + 1 < len(sizes) and (sizes[a + 1] / N) ** power / row['steps_per_sec'] > budget:
+                    break
+
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                   'machine': platform.machine(), 'results': results}, f, indent=1)
+    return results
+
+def initial_velocities(N, temperature=None):
+    '''
+    Gaussian velocities for the given temperature (m = kB = 1), or the
+    original uniform(-k, k) ones when no temperature is given.
+    '''
+    rng = np.random.default_rng(getrandbits(64))
+    if temperature is None:
+        return rng.uniform(-k, k, N), rng.uniform(-k, k, N)
+    sigma = math.sqrt(temperature)
+    return rng.normal(0, sigma, N), rng.normal(0, sigma, N)
+
+SWEEP_DEFAULTS = {'n': 100, 'box': 1000, 'temperature': 1000, 'seed': 0, 'steps': 1000,
+                  'dt': 0.001, 'engine': 'numpy', 'integrator': 'verlet', 'observe_every': 10}
+
+def sweep_runs(spec):
+    '''
+    Expands a sweep specification into the list of single runs. Every key
+    of SWEEP_DEFAULTS may be a value or a list of values, all combinations
+    are run. 'repeats': R runs each combination R times; the seeds of the
+    repeats are derived from the parameters, so they are the same on
+    every machine and every time the sweep is run.
+    '''
+    keys = list(SWEEP_DEFAULTS)
+    values = []
+    for key in keys:
+        v = spec.get(key, SWEEP_DEFAULTS[key])
+        values.append(v if isinstance(v, list) else [v])
+
+    runs = []
+    for combination in itertools.product(*values):
+        params = dict(zip(keys, combination))
+        for r in range(spec.get('repeats', 1)):
+            run = dict(params)
+            if r:
+                key = json.dumps([params, r], sort_keys=True).encode()
+                run['seed'] = int(hashlib.sha1(key).hexdigest()[:8], 16)
+            runs.append(run)
+    return runs
+
+def run_key(run):
+    return hashlib.sha1(json.dumps(run, sort_keys=True).encode()).hexdigest()[:16]
+
+def sweep_run(task):
+    '''
+    One headless simulation of a sweep, runs in a pool worker. The summary
+    is cached in cache_dir under the hash of the parameters.
+    '''
+    run, cache_dir = task
+    path = os.path.join(cache_dir, run_key(run) + '.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
 
-    
-    N = int(input('Введите количество частиц:\n'))
     global k
-    k = 1 / 2 * int(input('Введите размер коробки:\n'))
-    dt = 0.001
+    k = run['box'] / 2
+    seed(run['seed'])
+    xs, ys = place_particles(run['n'])
+    vxs, vys = initial_velocities(run['n'], run['temperature'])
+    gas, turtles = make_gas(run['engine'], xs, ys, vxs, vys, k)
+    advance = stepper(run['engine'], run['integrator'])
+    obs = Observables(None, run['n'], k, run['observe_every'])
 
+    rows = []
+    start = time.perf_counter()
+    for step in range(1, run['steps'] + 1):
+        if step % obs.every == 0:
+            gas.observer = obs
+        advance(gas, run['dt'])
+        if gas.observer:
+            gas.observer = None
+            rows.append(obs.sample(step, gas, step * run['dt']))
+    elapsed = time.perf_counter() - start
+
+    rows = np.array(rows).reshape(-1, len(Observables.COLUMNS))
+    summary = dict(run)
+    summary.update({
+        'steps_per_sec': run['steps'] / elapsed,
+        'mean_temperature': float(rows[:, 1].mean()) if len(rows) else None,
+        'mean_pressure': float(rows[:, 2].mean()) if len(rows) else None,
+        'mean_potential': float(rows[:, 3].mean()) if len(rows) else None,
+        'energy_drift': float((rows[-1, 4] - rows[0, 4]) / abs(rows[0, 4])) if len(rows) else None,
+    })
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(summary, f)
+    os.replace(tmp, path)
+    return summary
+
+def sweep(spec_path, out_path, cache_dir, jobs=None):
+    '''
+    Runs every simulation of the sweep in spec_path (JSON, see sweep_runs)
+    on a process pool and appends one CSV row per finished run to
+    out_path. Runs already in cache_dir are not simulated again.
+    '''
+    with open(spec_path) as f:
+        runs = sweep_runs(json.load(f))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = list(SWEEP_DEFAULTS) + ['steps_per_sec', 'mean_temperature', 'mean_pressure',
+                                      'mean_potential', 'energy_drift']
+    with open(out_path, 'w', newline='') as f, multiprocessing.Pool(jobs) as pool:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        tasks = [(run, cache_dir) for run in runs]
+        for done, summary in enumerate(pool.imap_unordered(sweep_run, tasks), 1):
+            writer.writerow(summary)
+            f.flush()
+            print('%d/%d' % (done, len(runs)), run_key({key: summary[key] for key in SWEEP_DEFAULTS}))
+
+def open_window(k):
     window = turtle.Screen()
-    window.tracer(N)
+    # nothing is drawn until render() calls window.update()
+    window.tracer(0)
 
     border=turtle.Turtle()
-    for i in range(N):
-        border.penup()
-        border.goto(k,k)
-        border.pendown()
-        border.goto(k,-k)
-        border.goto(-k,-k)
-        border.goto(-k,k)
-        border.goto(k,k)
-        border.hideturtle()
-    
-    particles=[0]*N
-    for i in range(N):
-            x = randint(-k, k)
-            y = randint(-k, k)
-            minr=1600
-            if i!=0:
-                for j in range(i-1):
-                    dr = (x - particles[j].x) ** 2 + (y - particles[j].y) ** 2
-                    minr = min(dr, minr)
-            while minr < 225:
-                minr = 1600
-                x = randint(-k+20, k-20)
-                y = randint(-k+20, k-20)
-                for j in range(i-1):
-                    dr = (x - particles[j].x) ** 2 + (y - particles[j].y) ** 2
-                    minr = min(dr, minr)
-                    
-                
-            particles[i]=Particle(x,y,randint(-k,k),randint(-k,k))
-
-    while True:
-        for i in range(N):
-            ax = 0
-            ay = 0
-
-            for j in range(N):
-                if j != i:
-                    dax, day = force(particles[i], particles[j])
-                
-                    ax += dax
-                    ay += day
-
-            particles[i].accelerate(ax, ay, dt)
-
-        for i in particles:
-            i.move(dt)
+    border.penup()
+    border.goto(k,k)
+    border.pendown()
+    border.goto(k,-k)
+    border.goto(-k,-k)
+    border.goto(-k,k)
+    border.goto(k,k)
+    border.hideturtle()
+    return window
 
-            i.x = -k + (i.x + k) % (2 * k)
-            i.y = -k + (i.y + k) % (2 * k)
+def render(window, turtles, gas):
+    for t, x, y in zip(turtles, by_id(gas, gas.x), by_id(gas, gas.y)):
+        t.goto(x, y)
+    window.update()
 
-        
-        
-main()        
-            
+def heat_palette():
+    '''
+    256 packed 0xRRGGBB colors from black through red and yellow to white.
+    '''
+    i = np.arange(256) * 3
+    r = np.clip(i, 0, 255)
+    g = np.clip(i - 255, 0, 255)
+    b = np.clip(i - 510, 0, 255)
+    return (r << 16 | g << 8 | b).astype(np.uint32)
+
+class PygameView:
+    '''
+    Draws the whole particle array in one pass: positions are turned into
+    pixel indices with numpy and written into a pixel buffer, which is
+    blitted with surfarray. Up to point_limit particles every particle is
+    a pixel colored by its speed; above that a density heatmap on a grid
+    of cell x cell pixels is drawn instead. Under the box there is a live
+    histogram of the particle speeds.
+    '''
+
+    def __init__(self, k, size=800, hist_height=120, point_limit=50000, cell=4):
+        pygame.init()
+        self.k = k
+        self.size = size
+        self.hist_height = hist_height
+        self.point_limit = point_limit
+        self.cell = cell
+        self.screen = pygame.display.set_mode((size, size + hist_height))
+        pygame.display.set_caption('Gas')
+        self.box = pygame.Surface((size, size), depth=32)
+        self.hist = pygame.Surface((size, hist_height), depth=32)
+        self.pixels = np.zeros((size, size), np.uint32)
+        self.palette = heat_palette()
+        # paced by the caller, render() itself never waits
+        self.clock = pygame.time.Clock()
+
+    def render(self, gas):
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+
+        size = self.size
+        x, y = np.asarray(gas.x), np.asarray(gas.y)
+        speed = np.hypot(gas.vx, gas.vy)
+        # a diverged run has inf/nan, which cast to INT_MIN below
+        finite = np.isfinite(x) & np.isfinite(y) & np.isfinite(speed)
+        if not finite.all():
+            x, y, speed = x[finite], y[finite], speed[finite]
+        ix = ((x + self.k) * (size / (2 * self.k))).astype(np.intp)
+        iy = ((self.k - y) * (size / (2 * self.k))).astype(np.intp)
+        np.clip(ix, 0, size - 1, out=ix)
+        np.clip(iy, 0, size - 1, out=iy)
+        top = max(float(speed.max()), 1e-30) if len(speed) else 1
+
+        if len(ix) <= self.point_limit:
+            self.pixels.fill(0)
+            self.pixels[ix, iy] = self.palette[(127 + 128 * speed / top).astype(np.intp)]
+        else:
+            m = size // self.cell
+            counts = np.bincount(ix // self.cell * m + iy // self.cell, minlength=m * m)
+            level = np.log1p(counts) * (255 / np.log1p(counts.max()))
+            heat = self.palette[level.astype(np.intp)].reshape(m, m)
+            self.pixels[:m * self.cell, :m * self.cell] = np.repeat(np.repeat(heat, self.cell, 0), self.cell, 1)
+        pygame.surfarray.blit_array(self.box, self.pixels)
+
+        # one bar per column group, filled from the bottom
+        h = self.hist_height
+        bins = size // 4
+        counts = np.histogram(speed, bins, (0, top))[0]
+        bars = (h - 1) * counts / max(counts.max(), 1)
+        column = bars[np.arange(size) * bins // size]
+        filled = np.arange(h)[None, :] >= h - column[:, None]
+        pygame.surfarray.blit_array(self.hist, np.where(filled, 0x30A0FF, 0x202020).astype(np.uint32))
+
+        self.screen.blit(self.box, (0, 0))
+        self.screen.blit(self.hist, (0, size))
+        pygame.display.flip()
+
+    def close(self):
+        pygame.quit()
+
+# n, latest buffer, frames published, seq of buffer 0 and 1, closed;
+# then k as a float64, the two buffers start at SHARED_DATA
+SHARED_HEADER = 8
+SHARED_DATA = 128
+
+class SharedPublisher:
+    '''
+    Publishes snapshots (x, y, vx, vy as float32) into a shared memory
+    double buffer for viewer processes, see view_shared. Every buffer has
+    a sequence number that is odd while the buffer is being written; a
+    frame is written into the buffer that is not the latest one and then
+    made the latest, so publishing never waits for a viewer and a viewer
+    never holds up the simulation. With viewer=True a viewer is started
+    as a separate program; more can attach by name at any time.
+    '''
+
+    def __init__(self, name, n, k, viewer=True):
+        self.shm = shared_memory.SharedMemory(name, create=True, size=SHARED_DATA + 2 * 16 * n)
+        self.header = np.ndarray(SHARED_HEADER, np.int64, self.shm.buf)
+        self.header[:] = 0
+        self.header[0] = n
+        np.ndarray(1, np.float64, self.shm.buf, SHARED_HEADER * 8)[0] = k
+        self.buffers = np.ndarray((2, 4, n), np.float32, self.shm.buf, SHARED_DATA)
+        self.viewer = None
+        if viewer:
+            self.viewer = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--view', name])
+
+    def render(self, gas):
+        header = self.header
+        b = 1 - header[1]
+        header[3 + b] += 1
+        buffer = self.buffers[b]
+        buffer[0] = gas.x
+        buffer[1] = gas.y
+        buffer[2] = gas.vx
+        buffer[3] = gas.vy
+        header[3 + b] += 1
+        header[1] = b
+        header[2] += 1
+
+    def close(self):
+        self.header[5] = 1
+        self.header = None
+        self.buffers = None
+        self.shm.close()
+        self.shm.unlink()
+        if self.viewer:
+            self.viewer.wait()
+
+def attach_shared(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before Python 3.13 an attached block is unlinked when the viewer exits
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def view_shared(name, fps=60):
+    '''
+    Viewer side of SharedPublisher: shows the latest complete frame at up
+    to fps frames per second until the window is closed or the simulation
+    ends. A frame is copied out and only used if the sequence number of
+    its buffer was even and unchanged around the copy, otherwise the
+    publisher was writing into it meanwhile and the copy is retried.
+    '''
+    if pygame is None:
+        raise SystemExit('the viewer needs pygame')
+    try:
+        shm = attach_shared(name)
+    except FileNotFoundError:
+        raise SystemExit('no frames published as %s, the simulation has ended or does not use '
+                         '--renderer shared' % name)
+    header = np.ndarray(SHARED_HEADER, np.int64, shm.buf)
+    n = int(header[0])
+    k = float(np.ndarray(1, np.float64, shm.buf, SHARED_HEADER * 8)[0])
+    buffers = np.ndarray((2, 4, n), np.float32, shm.buf, SHARED_DATA)
+    view = PygameView(k)
+    shown = 0
+    try:
+        while not header[5]:
+            frame = None
+            if header[2] != shown:
+                b = int(header[1])
+                seq = int(header[3 + b])
+                copy = buffers[b].copy()
+                if seq % 2 == 0 and header[3 + b] == seq:
+                    frame = copy
+                    shown = int(header[2])
+            if frame is None:
+                # only the window events, nothing new to draw
+                if any(event.type == pygame.QUIT for event in pygame.event.get()):
+                    break
+            elif view.render(types.SimpleNamespace(x=frame[0], y=frame[1], vx=frame[2], vy=frame[3])) is False:
+                break
+            view.clock.tick(fps)
+    finally:
+        view.close()
+        del header, buffers
+        shm.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Lennard-Jones gas in a periodic box')
+    parser.add_argument('-n', type=int, help='number of particles (asked with input() if not set)')
+    parser.add_argument('--box', type=int, help='box size (asked with input() if not set)')
+    parser.add_argument('--engine', choices=['direct', 'cells', 'numpy', 'hard'], default='cells',
+                        help='hard is event-driven hard disks of diameter 10 instead of LJ')
+    parser.add_argument('--integrator', choices=list(INTEGRATORS), default='euler')
+    parser.add_argument('--dt', type=float, default=0.001)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='pick dt every step from the largest speed and force, starting at --dt')
+    parser.add_argument('--dt-min', type=float, help='smallest adaptive dt (default dt / 100)')
+    parser.add_argument('--dt-max', type=float, help='largest adaptive dt (default 100 dt)')
+    parser.add_argument('--max-move', type=float, default=0.5,
+                        help='largest distance a particle may move in one adaptive step')
+    parser.add_argument('--force', choices=['exact', 'linear', 'cubic'], default='exact',
+                        help='analytic LJ force or an interpolated table with a smooth cutoff')
+    parser.add_argument('--table-size', type=int, default=4096)
+    parser.add_argument('--skin', type=float, default=20,
+                        help='Verlet list skin for the numpy engine, 0 searches all pairs every step')
+    parser.add_argument('--mixture', metavar='JSON',
+                        help='species file: {"mass": [...], "epsilon": ..., "sigma": ..., "fraction": [...]}')
+    parser.add_argument('--reorder-every', type=int, default=0, metavar='S',
+                        help='sort the particle storage along a Z-order curve every S steps (numpy engine)')
+    parser.add_argument('--float32', action='store_true',
+                        help='keep the numpy engine state in float32 (16 bytes per particle)')
+    parser.add_argument('--long-range', choices=['gravity', 'coulomb'],
+                        help='add a 1 / r force evaluated with a Barnes-Hut tree')
+    parser.add_argument('--strength', type=float, default=1000, help='strength of the long-range force')
+    parser.add_argument('--theta', type=float, default=0.5, help='Barnes-Hut opening angle')
+    parser.add_argument('--softening', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='split the numpy engine over this many processes')
+    parser.add_argument('--steps', type=int, default=0, help='stop after this many steps, 0 runs forever')
+    parser.add_argument('--render-every', type=int, default=1, metavar='K',
+                        help='draw every K steps, 0 never draws')
+    parser.add_argument('--traj', metavar='PATH', help='write a trajectory file')
+    parser.add_argument('--traj-every', type=int, default=10, metavar='M',
+                        help='trajectory frame every M steps')
+    parser.add_argument('--traj-quantize', action='store_true',
+                        help='store 16 bit quantized frames instead of float32')
+    parser.add_argument('--observe', metavar='PATH',
+                        help='write temperature, pressure and energy to PATH and g(r) to PATH.rdf.npy')
+    parser.add_argument('--observe-every', type=int, default=100, metavar='M')
+    parser.add_argument('--checkpoint', metavar='PATH', help='save the state to PATH periodically')
+    parser.add_argument('--checkpoint-every', type=int, default=1000, metavar='S')
+    parser.add_argument('--resume', metavar='PATH',
+                        help='continue from a checkpoint (N, box and dt come from the file)')
+    parser.add_argument('--clusters', metavar='PATH',
+                        help='write the cluster size distribution as JSON lines (numpy engine)')
+    parser.add_argument('--clusters-every', type=int, default=100, metavar='M')
+    parser.add_argument('--bond', type=float, default=1.5 * R0,
+                        help='distance below which two particles belong to one cluster')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='serve live metrics over HTTP (/metrics Prometheus text, / JSON), 0 picks a port')
+    parser.add_argument('--metrics-host', default='127.0.0.1')
+    parser.add_argument('--bench', metavar='OUT.json',
+                        help='run the headless benchmark sweep instead of a simulation')
+    parser.add_argument('--bench-sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument('--bench-densities', type=float, nargs='+', default=[1 / 2500, 1 / 900])
+    parser.add_argument('--bench-engines', nargs='+', choices=['direct', 'cells', 'numpy', 'hard'],
+                        default=['direct', 'cells', 'numpy'])
+    parser.add_argument('--bench-budget', type=float, default=10,
+                        help='seconds of stepping per benchmark case')
+    parser.add_argument('--seed', type=int, help='seed of the random module')
+    parser.add_argument('--temperature', type=float,
+                        help='gaussian initial velocities at this temperature instead of uniform(-k, k)')
+    parser.add_argument('--analyse', metavar='TRAJ',
+                        help='MSD, VACF and diffusion coefficient of a trajectory file')
+    parser.add_argument('--analyse-out', default='diffusion.csv', metavar='PATH')
+    parser.add_argument('--analyse-lags', type=int, metavar='L',
+                        help='longest lag in frames (default a quarter of the run)')
+    parser.add_argument('--analyse-chunk', type=int, default=256, metavar='C',
+                        help='frames read and correlated at a time')
+    parser.add_argument('--sweep', metavar='SPEC.json',
+                        help='run a parameter sweep instead of a simulation')
+    parser.add_argument('--sweep-out', default='sweep.csv', metavar='PATH')
+    parser.add_argument('--sweep-cache', default='sweep_cache', metavar='DIR')
+    parser.add_argument('--jobs', type=int, help='processes for --sweep (default all cores)')
+    parser.add_argument('--profile', action='store_true',
+                        help='time force, integration, wrapping, drawing and output per step')
+    parser.add_argument('--profile-every', type=int, default=1000, metavar='S')
+    parser.add_argument('--profile-out', metavar='PATH', help='write the summaries here instead of stderr')
+    parser.add_argument('--renderer', choices=['turtle', 'pygame', 'shared'], default='turtle',
+                        help='one turtle per particle, the whole array drawn into a pygame pixel buffer, '
+                             'or pygame in a separate viewer process fed through shared memory')
+    parser.add_argument('--shm-name', help='shared memory name for --renderer shared (default gas-PID)')
+    parser.add_argument('--view', metavar='NAME',
+                        help='attach a viewer to a simulation running with --renderer shared')
+    parser.add_argument('--view-fps', type=int, default=60)
+    parser.add_argument('--headless', action='store_true',
+                        help='run without turtle/Tk at all (same as --render-every 0)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.workers > 1 and args.engine != 'numpy':
+        raise SystemExit('--workers needs --engine numpy')
+
+    if args.bench:
+        benchmark(args.bench, args.bench_sizes, args.bench_densities, args.bench_engines,
+                  args.integrator, args.dt, args.steps or 100, args.bench_budget)
+        return
+    if args.sweep:
+        sweep(args.sweep, args.sweep_out, args.sweep_cache, args.jobs)
+        return
+    if args.view:
+        view_shared(args.view, args.view_fps)
+        return
+    if args.analyse:
+        result = analyse_trajectory(args.analyse, args.analyse_out, args.analyse_lags, args.analyse_chunk)
+        print('D from MSD slope %.6g, from VACF integral %.6g' % (result['D_msd'], result['D_vacf']))
+        return
+    if args.seed is not None:
+        seed(args.seed)
+
+    global k
+    step = 0
+    sim_time = 0.0
+    if args.resume:
+        xs, ys, vxs, vys, k, dt, step, kind, ids, sim_time, hard, species = load_checkpoint(args.resume)
+        N = len(xs)
+    else:
+        N = args.n
+        if N is None:
+            N = int(input('Введите количество частиц:\n'))
+        box = args.box
+        if box is None:
+            box = int(input('Введите размер коробки:\n'))
+        k = 1 / 2 * box
+        dt = args.dt
+    advance = stepper(args.engine, args.integrator)
+    if args.engine == 'hard':
+        if args.adaptive or args.long_range:
+            raise SystemExit('--engine hard has no time step to adapt and no long-range force')
+
+    adaptive = None
+    if args.adaptive:
+        adaptive = AdaptiveStep(advance, args.dt_min or args.dt / 100, args.dt_max or args.dt * 100,
+                                args.max_move)
+        advance = adaptive
+
+    mixture = None
+    if args.mixture:
+        if args.engine != 'numpy':
+            raise SystemExit('--mixture needs --engine numpy')
+        if args.force != 'exact':
+            raise SystemExit('--mixture needs --force exact, the force table is for a single species')
+        try:
+            mixture = Mixture.load(args.mixture)
+        except ValueError as e:
+            raise SystemExit('%s: %s' % (args.mixture, e))
+        if not args.resume:
+            kind = mixture.assign(N)
+        elif kind is None:
+            raise SystemExit('%s was not saved from a mixture' % args.resume)
+        elif kind.max(initial=0) >= mixture.species:
+            raise SystemExit('%s has %d species, %s has fewer'
+                             % (args.resume, kind.max() + 1, args.mixture))
+        elif species is not None and not all(
+                np.array_equal(a, b) for a, b in zip(species, (mixture.mass, mixture.epsilon, mixture.sigma2))):
+            raise SystemExit('the species in %s differ from the ones %s was saved with'
+                             % (args.mixture, args.resume))
+    elif args.resume and kind is not None:
+        raise SystemExit('%s was saved from a mixture, resume it with the same --mixture' % args.resume)
+
+    global FORCE_TABLE
+    if args.force != 'exact':
+        FORCE_TABLE = ForceTable(args.table_size, 1 if args.force == 'linear' else 3)
+
+    render_every = args.render_every
+    if args.headless:
+        render_every = 0
+    draw = render_every > 0
+
+    if draw and args.renderer == 'turtle':
+        if turtle is None:
+            raise SystemExit('turtle/Tk not available, use --headless')
+        window = open_window(k)
+    if draw and args.renderer == 'pygame' and pygame is None:
+        raise SystemExit('pygame not available, use --headless or --renderer turtle')
+
+    if not args.resume:
+        try:
+            xs, ys = place_particles(N)
+        except ValueError as e:
+            raise SystemExit(e)
+        vxs, vys = initial_velocities(N, args.temperature)
+        if mixture:
+            # the same temperature for every species
+            vxs = vxs / np.sqrt(mixture.mass[kind])
+            vys = vys / np.sqrt(mixture.mass[kind])
+
+    gas, turtles = make_gas(args.engine, xs, ys, vxs, vys, k, args.workers,
+                            draw and args.renderer == 'turtle',
+                            np.float32 if args.float32 else float, args.skin)
+
+    view = None
+    draw_frame = None
+    if draw and args.renderer == 'pygame':
+        view = PygameView(k)
+        draw_frame = view.render
+    elif draw and args.renderer == 'shared':
+        name = args.shm_name or 'gas-%d' % os.getpid()
+        view = SharedPublisher(name, N, k)
+        draw_frame = view.render
+        print('publishing frames as', name, file=sys.stderr)
+    elif draw:
+        draw_frame = functools.partial(render, window, turtles)
+
+    if mixture:
+        gas.set_mixture(mixture, kind)
+
+    if args.reorder_every and not isinstance(gas, Gas):
+        raise SystemExit('--reorder-every needs --engine numpy')
+    if args.resume and ids is not None and isinstance(gas, Gas):
+        gas.permute(ids)
+    if args.resume and isinstance(gas, HardSphereGas):
+        if hard is None:
+            raise SystemExit('%s was not saved from --engine hard' % args.resume)
+        gas.restore(hard)
+
+    if args.long_range:
+        strength = args.strength if args.long_range == 'coulomb' else -args.strength
+        gas.long_range = BarnesHut(k, strength, args.theta, args.softening)
+
+    obs = None
+    if args.observe:
+        obs = Observables(args.observe, N, k, args.observe_every)
+
+    clusters = None
+    if args.clusters:
+        if not isinstance(gas, Gas):
+            raise SystemExit('--clusters needs --engine numpy')
+        clusters = Clusters(args.clusters, N, args.clusters_every, args.bond)
+
+    write_checkpoint = save_checkpoint
+    prof = None
+    if args.profile:
+        prof = Profiler(open(args.profile_out, 'a') if args.profile_out else sys.stderr,
+                        args.profile_every)
+        prof.attach(gas)
+        if draw_frame:
+            draw_frame = prof.wrap('draw', draw_frame)
+        if args.checkpoint:
+            write_checkpoint = prof.wrap('checkpoint', save_checkpoint)
+        if obs:
+            obs.sample = prof.wrap('observe', obs.sample)
+        if clusters:
+            clusters.sample = prof.wrap('clusters', clusters.sample)
+
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = Metrics(N, prof, step)
+        port = serve_metrics(metrics, args.metrics_port, args.metrics_host)
+        print('metrics on http://%s:%d/metrics' % (args.metrics_host, port), file=sys.stderr)
+
+    traj = None
+    if args.traj:
+        capacity = 1024
+        if args.steps:
+            capacity = args.steps // args.traj_every + 1
+        traj = TrajectoryWriter(args.traj, N, k, dt, args.traj_every, args.traj_quantize, capacity,
+                                step if args.resume else None)
+        # a resumed run keeps the frames on the --traj-every grid
+        if step % args.traj_every == 0:
+            traj.write(step, gas, sim_time)
+        if prof:
+            traj.write = prof.wrap('trajectory', traj.write)
+
+    while args.steps == 0 or step < args.steps:
+        due = [o for o in (obs, clusters) if o and (step + 1) % o.every == 0]
+        if len(due) == 1:
+            gas.observer = due[0]
+        elif due:
+            gas.observer = Observers(due)
+        advance(gas, dt)
+        step += 1
+        if adaptive:
+            dt = adaptive.dt
+        sim_time += dt
+
+        if due:
+            gas.observer = None
+            for o in due:
+                row = o.sample(step, gas, sim_time)
+                if metrics and o is obs:
+                    metrics.observe(row)
+        if metrics:
+            metrics.tick(step)
+
+        if traj and step % args.traj_every == 0:
+            traj.write(step, gas, sim_time)
+
+        if args.reorder_every and step % args.reorder_every == 0:
+            gas.reorder()
+
+        if args.checkpoint and step % args.checkpoint_every == 0:
+            write_checkpoint(args.checkpoint, gas, step, dt, sim_time)
+
+        if draw and step % render_every == 0:
+            # False when the window was closed
+            if draw_frame(gas) is False:
+                break
+
+        if prof:
+            prof.end_step()
+
+    if args.checkpoint and step % args.checkpoint_every != 0:
+        save_checkpoint(args.checkpoint, gas, step, dt, sim_time)
+    if view:
+        view.close()
+    if obs:
+        obs.close()
+    if clusters:
+        clusters.close()
+    if traj:
+        traj.close()
+    if args.workers > 1:
+        gas.close()
+    if args.profile_out:
+        prof.out.close()
+
+
+if __name__ == '__main__':
+    main()